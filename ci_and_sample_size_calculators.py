@@ -1,37 +1,55 @@
+import numpy as np
+from scipy.stats import norm
+
+## Thompson's published d2n-values, used as they are for these miss-rates so results don't change
+D2N_TABLE = {0.05: 1.27359, 0.01: 1.96986, 0.005: 2.28514, 0.001: 3.02892}
+
+def _scalar_or_array(values):
+  """Returns a plain number for 0-d results so scalar inputs give scalar outputs"""
+  return values.item() if values.ndim == 0 else values
+
+def thompson_d2n(miss=0.05, max_categories=100):
+  """This function calculates Thompson's d2n-value for any miss-rate (alpha level), or an array of
+  miss-rates: the maximum over the number of categories m of z(miss/2m)**2 * (1/m) * (1 - 1/m), where
+  z is the upper quantile of the standard normal distribution. The maximum is found among 1 to
+  max_categories categories (it is reached at m = 2 or 3 for the usual miss-rates). For further
+  information about this method see Thompson, The American Statestician (1987)"""
+  miss = np.asarray(miss, dtype=float)
+  if not np.all((miss > 0) & (miss < 1)):
+    raise ValueError("Miss has to be between 0 and 1")
+
+  ## Solve once per distinct miss-rate, for all numbers of categories at the same time
+  unique_miss, inverse = np.unique(miss, return_inverse=True)
+  m = np.arange(1, max_categories + 1, dtype=float)[:, np.newaxis]
+  d2n = (norm.isf(unique_miss/(2*m))**2 * (1/m) * (1 - 1/m)).max(axis=0)
+  for index, value in enumerate(unique_miss):
+    if value in D2N_TABLE:
+      d2n[index] = D2N_TABLE[value]
+  return d2n[inverse].reshape(miss.shape)
+
 def multinomial_sample_size(width=0.05, miss=0.05):
   """This function calculates sample sizes for multiple option questions,
   based on a given miss-rate (alpha level), and the width of the desired confidence intervals.
-  Only miss-rates of 0.05, 0.01, 0.005 and 0.001 are supported. For further information about this
-  method see Thompson, The American Statestician (1987)"""
-  
-  ## Generate an object for the dn2-values indexed by the various alpha levels
-  d2n = {'0.05' : 1.27359, '0.01': 1.96986, '0.005':2.28514, '0.001':3.02892}
-  
-  
-  ## If Miss (alpha) is not a key to the dictionary above raise an error 
-  if (str(miss) not in ['0.05', '0.01', '0.005', '0.001']):
-    print "Miss can only be set to 0.05 0.01, please try again"
-  
-  ## Otherwise calculate the sample size
-  else:
-    sample_size=d2n[str(miss)]/(width**2)
-    return round(sample_size + 0.4999999999) # The constant at the end ensures that the function rounds to the next
-    # integer without importing a ceiling function from math or numpy
+  Width and miss can be numbers or arrays (e.g. one per stratum of a sampling frame), arrays are
+  broadcast against each other and give an array of sample sizes. Any miss-rate between 0 and 1 is
+  supported (see thompson_d2n). For further information about this method see Thompson,
+  The American Statestician (1987)"""
+  width = np.asarray(width, dtype=float)
+  if not np.all(width > 0):
+    raise ValueError("Width has to be larger than 0")
+
+  sample_size = thompson_d2n(miss)/(width**2)
+  ## Round up to the next integer, ignoring floating point noise just above an integer
+  return _scalar_or_array(np.ceil(sample_size - 1e-10))
 
 def multinomial_CI(N=100, miss=0.05):
   """This function calculates confidence intervals for multiple option questions, based on a given
-  miss-rate (alpha level), and the sample size (N). Only miss-rates of 0.05, 0.01, 0.005 and 0.001
-  are supported. For further information about this method Thompson, The American Statestician (1987)"""
-  
-  ## Generate an object for the dn2-values indexed by the various alpha levels
-  d2n = {'0.05' : 1.27359, '0.01': 1.96986, '0.005':2.28514, '0.001':3.02892}
-  
-  ## If Miss (alpha) is not a key to the dictionary above raise an error 
-  if (str(miss) not in ['0.05', '0.01', '0.005', '0.001']):
-    print "Miss can only be set to 0.05 0.01, please try again"
-  
-  ## Otherwise calculate the width of the confidence intervals
-  else:
-    d=(d2n[str(miss)]/N)**0.5
-    return round(d, 2)
+  miss-rate (alpha level), and the sample size (N). N and miss can be numbers or arrays, arrays are
+  broadcast against each other and give an array of widths. Any miss-rate between 0 and 1 is supported
+  (see thompson_d2n). For further information about this method Thompson, The American Statestician (1987)"""
+  N = np.asarray(N, dtype=float)
+  if not np.all(N > 0):
+    raise ValueError("N has to be larger than 0")
 
+  d = (thompson_d2n(miss)/N)**0.5
+  return _scalar_or_array(np.round(d, 2))
@@ -11,10 +11,16 @@ __version__ = '0.1'
 __author__ = 'Tomas Folke'
 
 # Import libraries
+import re
+import difflib
 import numpy as np
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
+from gen_templates import Template, parse_response_options, LABEL_PUNCTUATION_PATTERN
+
+DONT_KNOW_RESPONSES = ['6_dont_know', '3_dont_know', '7_dont_want_to_answer', '4_dont_want_to_answer']
+_NON_ASCII_PATTERN = re.compile(r'[^\x00-\x7f]')
 
 def mismatch_search(data, template):
     """Compares the columns with a data frame to the index of a transposed matrix, and identifies columns
@@ -23,8 +29,9 @@ def mismatch_search(data, template):
     mismatches = []
     mismatch_numbers = []
     mismatch_number = 0
+    template_labels = set(Template.compile(template).names)
     for column in data.columns:
-        if column not in template.index:
+        if column not in template_labels:
             mismatches.append(column)
             mismatch_numbers.append(mismatch_number)
         mismatch_number +=1
@@ -37,7 +44,7 @@ def find_suggested_labels(mismatches, template):
     """
     suggestion_list = []
     mismatch_prefixes = [mismatch.split('_')[0] for mismatch in mismatches]
-    for label in template.index:
+    for label in Template.compile(template).names:
         if label.split('_')[0] in mismatch_prefixes:
             suggestion_list.append(label)
     return suggestion_list
@@ -58,9 +65,83 @@ def gen_match_dict(mismatches, suggestions):
     if len(mismatches) == len(matching_dict):
         return matching_dict
     else:
-        return np.nan
         print 'Matching failed, the following data columns lack suggestions:'
         print mismatches_no_partner
+        return np.nan
+
+def normalize_label(label):
+    """Normalizes a question label for matching: lower case, with every run of punctuation and whitespace
+    replaced by a single underscore"""
+    return re.sub('[^0-9a-z]+', '_', label.lower()).strip('_')
+
+def _label_prefix(label):
+    """Returns the question prefix of a label in lower case, e.g. 'q12' for 'Q12_are_you_safe' and 'q2-1'
+    for the open list label 'Q2-1_needs' (split on the first underscore, as gen_match_dict does)"""
+    return label.split('_')[0].lower()
+
+def reconcile_columns(columns, template, n_candidates=3):
+    """Matches data columns to the labels of a (transposed) template and reports the result.
+
+    The template is indexed once by normalized label and by question prefix, so every column is
+    looked up in constant time instead of being compared with every template label. Returns a data
+    frame with one row per column and the following status:
+    'exact': the column is a template label.
+    'matched': exactly one unused template label has the same normalized label or question prefix (the
+    part before the first underscore, so open list labels like Q2-1_... keep their own prefix).
+    'ambiguous': several unused template labels share the question prefix, or several columns match
+    the same label.
+    'unmatched': no template label shares the question prefix.
+    Candidates for ambiguous and unmatched columns are ranked by string similarity, match is the best
+    candidate for 'matched' columns. Use reconciled_match_dict to turn the report into a rename dict."""
+    labels = Template.compile(template).names
+    used = set(columns) & set(labels)
+    by_normalized = {}
+    by_prefix = {}
+    for label in labels:
+        if label in used:
+            continue
+        by_normalized.setdefault(normalize_label(label), []).append(label)
+        by_prefix.setdefault(_label_prefix(label), []).append(label)
+
+    rows = []
+    unmatched_labels = None
+    for column in columns:
+        if column in used:
+            rows.append((column, 'exact', column, [column]))
+            continue
+        normalized = normalize_label(column)
+        candidates = by_normalized.get(normalized, [])
+        if len(candidates) != 1:
+            candidates = by_prefix.get(_label_prefix(column), [])
+        if len(candidates) == 1:
+            rows.append((column, 'matched', candidates[0], candidates))
+            continue
+
+        if candidates:
+            status = 'ambiguous'
+        else:
+            # Only columns without any prefix candidate are compared against the whole template
+            status = 'unmatched'
+            if unmatched_labels is None:
+                unmatched_labels = [label for label in labels if label not in used]
+            candidates = unmatched_labels
+        scores = [(difflib.SequenceMatcher(None, normalized, normalize_label(candidate)).ratio(), candidate)
+                  for candidate in candidates]
+        ranked = [candidate for score, candidate in sorted(scores, reverse=True)[:n_candidates]]
+        rows.append((column, status, np.nan, ranked))
+
+    report = pd.DataFrame(rows, columns=['column', 'status', 'match', 'candidates'])
+    # A template label claimed by several columns can't be used to rename any of them
+    claimed_twice = (report['status'] == 'matched') & report['match'].duplicated(keep=False)
+    report.loc[claimed_twice, 'status'] = 'ambiguous'
+    report.loc[claimed_twice, 'match'] = np.nan
+    print report['status'].value_counts().to_dict()
+    return report
+
+def reconciled_match_dict(report):
+    """Creates a dictionary to rename the matched columns of a reconcile_columns report"""
+    matched = report.loc[report['status'] == 'matched', :]
+    return dict(zip(matched['column'], matched['match']))
 
 def print_response_overview(data, columns):
     """Prints frequency counts for a list of columns in a data frame"""
@@ -71,22 +152,34 @@ def print_response_overview(data, columns):
 
 def count_response_proportions(data, template, columns):
     """Prints response proportions for likert scale and binary questions in a column list"""
+    template = Template.compile(template)
     for column in columns:
         temp = pd.DataFrame(data.loc[:, column].value_counts(normalize=True))
         temp = temp.reset_index()
         temp.columns = column, 'frequency'
         temp = temp.sort_values(by=column).reset_index(drop=True)
-        if template.loc[column, 'question_type'] == 'likert':
+        if template[column].question_type == 'likert':
             print temp
-        elif template.loc[column, 'question_type'] == 'binary':
+        elif template[column].question_type == 'binary':
             print temp
 
 def delete_dont_knows(data, columns):
     """Deletes "don't know" and "don't want to answer responses" from specified columns"""
-    data.loc[:, columns] = data.loc[:, columns].replace(['6_dont_know', '3_dont_know', '7_dont_want_to_answer', '4_dont_want_to_answer'], np.nan)
+    columns = list(columns)
+    categorical_columns = [column for column in columns if data[column].dtype.name == 'category']
+    for column in categorical_columns:
+        dont_knows = [response for response in DONT_KNOW_RESPONSES if response in data[column].cat.categories]
+        data[column] = data[column].cat.remove_categories(dont_knows)
+    columns = [column for column in columns if column not in categorical_columns]
+    if columns:
+        data.loc[:, columns] = data.loc[:, columns].replace(DONT_KNOW_RESPONSES, np.nan)
 
-def reverse_question_scoring(data, question, include_dont_knows=False):
+def reverse_question_scoring(data, question, include_dont_knows=False, template=None):
     """Reverses the numbers at the beginning of the response alternatives"""
+    if data[question].dtype.name == 'category':
+        return _reverse_categorical_scoring(data[question], include_dont_knows,
+                                            Template.compile(template)[question].options if template is not None else None,
+                                            question)
     response_numbers = [np.int(answer.split('_')[0]) for answer in data[question]]
     response_numbers = np.array(response_numbers)
     if include_dont_knows == True:
@@ -99,9 +192,83 @@ def reverse_question_scoring(data, question, include_dont_knows=False):
         updated_responses.append(np.str(response_numbers[x]) + '_' + '_'.join(response_splits[x][1:]))
     return updated_responses
 
+def _reverse_categorical_scoring(responses, include_dont_knows=False, options=None, question=None):
+    """Version of reverse_question_scoring for categorical columns, which only re-labels the categories
+    and keeps the integer codes (and the missing values) of the responses.
+
+    The scale maximum is taken from the template options if they are given, otherwise from the
+    categories (which encode_responses sets to the template options), so categories nobody chose don't
+    change it. Don't knows (unless include_dont_knows) and categories without a number keep their label."""
+    if options is None:
+        options = responses.cat.categories
+    scale_max = _scale_max(options, question, include_dont_knows)
+    return _relabel_categories(responses, _reversed_labels(responses.cat.categories, scale_max,
+                                                           include_dont_knows)).values
+
+def _response_prefix(response):
+    """Returns the number at the beginning of a response alternative, or None if it has no number"""
+    prefix = str(response).split('_')[0]
+    if prefix.isdigit():
+        return np.int(prefix)
+    return None
+
+def _scale_max(options, question=None, include_dont_knows=False):
+    """The largest number at the beginning of the response options, leaving out don't knows unless
+    include_dont_knows. Raises a ValueError if no option has a number."""
+    numbers = [_response_prefix(option) for option in options if _response_prefix(option) is not None
+               and (include_dont_knows == True or option not in DONT_KNOW_RESPONSES)]
+    if not numbers:
+        raise ValueError('%s has no numbered response options to reverse: %s' %(question, list(options)))
+    return max(numbers)
+
+def _reversed_labels(responses, scale_max, include_dont_knows=False):
+    """Maps response alternatives to alternatives with reversed numbers. Alternatives without a number
+    keep their label, and so do don't knows unless include_dont_knows (then they are reversed with the
+    rest, counting from 0 as reverse_question_scoring does)."""
+    mapping = {}
+    for response in responses:
+        number = _response_prefix(response)
+        if number is None or (include_dont_knows != True and response in DONT_KNOW_RESPONSES):
+            mapping[response] = response
+        elif include_dont_knows == True:
+            mapping[response] = np.str(scale_max - number) + '_' + response.split('_', 1)[1]
+        else:
+            mapping[response] = np.str(scale_max - number + 1) + '_' + response.split('_', 1)[1]
+    return mapping
+
+def _sorted_categories(categories):
+    """Sorts response alternatives by their number, alternatives without a number come last"""
+    return sorted(categories, key=lambda category: (_response_prefix(category) is None,
+                                                    _response_prefix(category), category))
+
+def _relabel_categories(responses, mapping):
+    """Renames the categories of a categorical series through a mapping and sorts the new categories by
+    their number, the integer codes of the responses are kept"""
+    responses = pd.Series(responses)
+    relabelled = responses.cat.rename_categories([mapping[category] for category in responses.cat.categories])
+    return relabelled.cat.reorder_categories(_sorted_categories(relabelled.cat.categories))
+
+def reverse_questions(data, template, questions):
+    """Reverses the scoring of several questions in place.
+
+    Unlike reverse_question_scoring the scale maximum is taken from the response options in the
+    template, so it does not depend on which responses happen to be in the data. Don't knows and
+    missing values are left as they are. Every column is relabelled through a mapping of its unique
+    responses (or its categories, for categorical columns) rather than row by row. Raises a ValueError
+    if a question has no numbered response options."""
+    template = Template.compile(template)
+    for question in questions:
+        scale_max = _scale_max(template[question].options, question)
+        responses = data[question]
+        if responses.dtype.name == 'category':
+            data[question] = _relabel_categories(responses, _reversed_labels(responses.cat.categories, scale_max))
+        else:
+            mapping = _reversed_labels(responses.dropna().unique(), scale_max)
+            data[question] = responses.map(mapping)
+
 def bin_quantities(data, template, quantiles=3):
     """Bins quantitative data"""
-    for column in template.loc[template['question_type']=='quantity', :].index:
+    for column in [question.name for question in Template.compile(template).of_type('quantity')]:
         print column
         extracted_quantities = []
         if data[column].dtype == str:
@@ -112,12 +279,204 @@ def bin_quantities(data, template, quantiles=3):
 
 def remove_non_ascii(text):
     """Remove non-ascii symbols from a string"""
-    return ''.join([i if ord(i) < 128 else ' ' for i in text])
+    return _NON_ASCII_PATTERN.sub(' ', text)
+
+def _normalize_string(text, lower, collapse_whitespace, strip_punctuation):
+    """Normalizes a single string, see normalize_text"""
+    text = _NON_ASCII_PATTERN.sub(' ', text)
+    if strip_punctuation:
+        text = LABEL_PUNCTUATION_PATTERN.sub('', text)
+    if lower:
+        text = text.lower()
+    if collapse_whitespace:
+        text = ' '.join(text.split())
+    return text
+
+def normalize_text(texts, lower=True, collapse_whitespace=True, strip_punctuation=False):
+    """Normalizes the text in a series: replaces non-ascii symbols with spaces and optionally lower-cases,
+    collapses whitespace and strips the punctuation gen_templates removes from labels.
+
+    Every distinct value is only normalized once and the results are mapped back onto the series, so
+    repeated answers cost nothing extra. Missing values and non-text values are kept. Categorical series
+    stay categorical (categories that become identical are merged)."""
+    if texts.dtype.name == 'category':
+        categories = [_normalize_string(category, lower, collapse_whitespace, strip_punctuation)
+                      if isinstance(category, basestring) else category for category in texts.cat.categories]
+        category_codes, categories = pd.factorize(categories)
+        codes = np.asarray(texts.cat.codes)
+        codes = np.where(codes >= 0, category_codes[codes], -1)
+        return pd.Series(pd.Categorical.from_codes(codes, categories), index=texts.index, name=texts.name)
+
+    mapping = {}
+    for text in pd.unique(texts.dropna()):
+        if isinstance(text, basestring):
+            mapping[text] = _normalize_string(text, lower, collapse_whitespace, strip_punctuation)
+        else:
+            mapping[text] = text
+    return texts.map(mapping)
+
+def normalize_text_columns(data, columns, lower=True, collapse_whitespace=True, strip_punctuation=False):
+    """Normalizes the text in several columns in place, see normalize_text"""
+    for column in columns:
+        data[column] = normalize_text(data[column], lower, collapse_whitespace, strip_punctuation)
+
+def remove_non_ascii_columns(data, columns):
+    """Removes non-ascii symbols from the text in several columns, in place"""
+    normalize_text_columns(data, columns, lower=False, collapse_whitespace=False)
 
 def replace_response_categories(data, column, old_responses, new_response):
     """Quick way to reassign cell information inside a pandas dataframe."""
-    data.loc[data[column].isin(old_responses), column] = new_response
+    if data[column].dtype.name == 'category':
+        if new_response not in data[column].cat.categories:
+            categories = sorted(list(data[column].cat.categories) + [new_response])
+            data[column] = data[column].cat.set_categories(categories)
+        data.loc[data[column].isin(old_responses), column] = new_response
+        unused = [response for response in old_responses
+                  if response in data[column].cat.categories and response != new_response]
+        data[column] = data[column].cat.remove_categories(unused)
+    else:
+        data.loc[data[column].isin(old_responses), column] = new_response
 
 def whole_number(string):
     '''Rounds a string of decimals to whole numbers'''
     return [ '%.0f' %float(elem) for elem in string.split() ]
+
+def parse_multiple_choice(responses, options):
+    """Turns a comma separated multiple choice column (e.g. 'option_a, option_c', as gen_examples
+    simulates it) into a packed indicator matrix: a rows x ceil(n_options/8) uint8 array in the
+    np.packbits layout, where bit j of a row is set if the respondent chose options[j].
+
+    options are the response options of the column, as a list or a template cell. Every distinct
+    combination of options is only parsed once, missing responses select no options and answers that
+    are not among the options are reported and left out. Use unpack_multiple_choice to get the boolean
+    rows x options matrix back."""
+    options = parse_response_options(options)
+    option_index = dict([(option, index) for index, option in enumerate(options)])
+    codes, combinations = pd.factorize(responses)
+    # one extra row of zeros at the end, missing responses have code -1
+    combination_options = np.zeros((len(combinations) + 1, len(options)), dtype=bool)
+    unknown = set()
+    for row, combination in enumerate(combinations):
+        for option in str(combination).split(','):
+            option = option.strip()
+            if option in option_index:
+                combination_options[row, option_index[option]] = True
+            elif option:
+                unknown.add(option)
+    if unknown:
+        print responses.name, 'has responses that are not in the template:', sorted(unknown)
+    return np.packbits(combination_options, axis=1)[codes]
+
+def unpack_multiple_choice(packed, n_options):
+    """Turns a packed indicator matrix from parse_multiple_choice back into a rows x options boolean
+    matrix"""
+    return np.unpackbits(packed, axis=1)[:, :n_options].astype(bool)
+
+def encode_responses(data, template):
+    """Stores likert, binary and multiple choice columns as pandas categoricals.
+
+    Likert and binary columns get ordered categories from the response options in the (transposed)
+    template, multiple choice columns get their observed response combinations as categories. Responses
+    that are missing from the template are kept, added after the template options, and reported. The
+    data frame is changed in place."""
+    for question in Template.compile(template):
+        column, question_type = question.name, question.question_type
+        if column not in data.columns:
+            continue
+        observed = sorted(data[column].dropna().unique())
+        if question_type in ['likert', 'binary']:
+            categories = question.options
+        elif question_type == 'multiple_choice':
+            categories = observed
+        else:
+            continue
+        unexpected = [response for response in observed if response not in categories]
+        if unexpected:
+            print column, 'has responses that are not in the template:', unexpected
+        data[column] = pd.Categorical(data[column], categories=list(categories) + unexpected,
+                                      ordered=question_type != 'multiple_choice')
+
+def response_numbers(responses):
+    """Returns the numbers at the beginning of the response alternatives as floats, NaN for missing values
+    and for responses without a number (e.g. 'Other').
+
+    For categorical columns only the categories are parsed, and the numbers are looked up by integer code."""
+    if responses.dtype.name == 'category':
+        codes = np.asarray(responses.cat.codes)
+        numbers = np.array([_response_number(category) for category in responses.cat.categories] + [np.nan])
+        # missing values have code -1, which picks the trailing NaN
+        return numbers[codes]
+    return np.array([_response_number(answer) if answer == answer else np.nan for answer in responses])
+
+def _response_number(response):
+    """The number at the beginning of a response alternative as a float (see _response_prefix), NaN if
+    it has no number"""
+    number = _response_prefix(response)
+    return np.nan if number is None else np.float(number)
+
+class CleaningPipeline(object):
+    """Chains cleaning steps and applies them to a csv file one chunk at a time.
+
+    Steps are added with the methods named after the cleaning functions and run in the order they were
+    added, e.g. CleaningPipeline(template).delete_dont_knows(columns).reverse_questions(questions).
+    Reversing uses reverse_questions, which takes the scale maximum from the template and therefore gives
+    the same result whichever chunk a response is in. run() reads the input with
+    pd.read_csv(chunksize=...), writes every cleaned chunk to the output file straight away and counts
+    the responses of the questions given to count_responses, so the full data set is never in memory.
+    """
+
+    def __init__(self, template):
+        self.template = template
+        self.steps = []
+        self.count_questions = []
+        self.counts = {}
+
+    def delete_dont_knows(self, columns):
+        self.steps.append((delete_dont_knows, (list(columns),)))
+        return self
+
+    def replace_response_categories(self, column, old_responses, new_response):
+        self.steps.append((replace_response_categories, (column, old_responses, new_response)))
+        return self
+
+    def reverse_questions(self, questions):
+        self.steps.append((reverse_questions, (Template.compile(self.template), list(questions))))
+        return self
+
+    def remove_non_ascii(self, columns):
+        self.steps.append((remove_non_ascii_columns, (list(columns),)))
+        return self
+
+    def count_responses(self, questions):
+        """Sets the questions whose response frequencies are accumulated while the pipeline runs"""
+        self.count_questions = list(questions)
+        return self
+
+    def apply(self, data):
+        """Applies the cleaning steps to a data frame in place and returns it"""
+        for step, arguments in self.steps:
+            step(data, *arguments)
+        return data
+
+    def run(self, input_path, output_path=None, chunksize=100000, accumulator=None, **read_csv_kwargs):
+        """Cleans a csv file chunk by chunk, appending the cleaned chunks to output_path.
+
+        Returns a dictionary of response counts (pandas series) for the questions given to count_responses,
+        see summary_tables_and_plotting.gen_summary_table_from_counts. If an accumulator (e.g. a
+        summary_tables_and_plotting.FrequencyAccumulator) is given, every cleaned chunk is also added
+        to it with accumulator.update(chunk)."""
+        self.counts = {}
+        chunks = pd.read_csv(input_path, chunksize=chunksize, **read_csv_kwargs)
+        for chunk_number, chunk in enumerate(chunks):
+            self.apply(chunk)
+            if accumulator is not None:
+                accumulator.update(chunk)
+            if output_path is not None:
+                chunk.to_csv(output_path, index=False, header=chunk_number == 0,
+                             mode='w' if chunk_number == 0 else 'a')
+            for question in self.count_questions:
+                counts = chunk[question].value_counts()
+                if question in self.counts:
+                    counts = self.counts[question].add(counts, fill_value=0)
+                self.counts[question] = counts
+        return self.counts
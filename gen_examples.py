@@ -13,21 +13,24 @@ __version__ = '0.1'
 __author__ = 'Tomas Folke'
 
 # import libraries
+import csv
+import collections
+import multiprocessing
 import numpy as np
 import pandas as pd
 import itertools as it
+from gen_templates import Template
 
 def load_template():
-    """Loads csv from a path specificed by the user and returns a pandas data frame"""
+    """Loads a template csv from a path specificed by the user and returns it as a Template
+    (see gen_templates.Template), parsed once and cached in the user's template cache"""
     csv_path =  raw_input("Please specify path to template")
-    template = pd.read_csv(csv_path, header=0, index_col=0)
+    template = Template.load(csv_path)
     return template
 
 def extract_response_options(template, column):
     """Transforms the response options inside a data frame cell from a string to a list"""
-    options = template.loc['response_options', column].translate(None, "[]',")
-    options = options.split()
-    return options
+    return list(Template.compile(template)[column].options)
 
 def extract_multiple_choice_combinations(options, combo=0):
     """Generates a list of all possible combinations from multiple choice questions"""
@@ -39,105 +42,263 @@ def extract_multiple_choice_combinations(options, combo=0):
             combinations_list.extend(list(it.combinations(options, i)))
     return combinations_list
 
+def iter_multiple_choice_combinations(options, combo=0):
+    """Yields the combinations of extract_multiple_choice_combinations one at a time as response strings,
+    so that the power set is never held in memory"""
+    if combo == 0:
+        combo = len(options)
+    for i in range(1, combo+1):
+        for combination in it.combinations(options, i):
+            yield ', '.join(combination)
+
+def _n_combinations(n_options, size):
+    """Number of ways to pick size options out of n_options"""
+    n_combinations = 1
+    for i in range(1, size+1):
+        n_combinations = n_combinations * (n_options - i + 1) // i
+    return n_combinations
+
+def count_multiple_choice_combinations(n_options, combo=0):
+    """Counts the combinations extract_multiple_choice_combinations would generate without generating them"""
+    if combo == 0:
+        combo = n_options
+    return sum([_n_combinations(n_options, size) for size in range(1, combo+1)])
+
+def sample_multiple_choice_masks(n_options, n_row, combo=0, random_state=np.random):
+    """Samples multiple choice combinations as bitmask integers, where bit i is set if option i was picked.
+
+    Every combination of up to combo options is equally likely, as when sampling from
+    extract_multiple_choice_combinations, but the combinations are never enumerated: the number of
+    picked options is drawn first, weighted by how many combinations of that size exist, and then that
+    many distinct options are drawn for every row."""
+    if n_options > 62:
+        raise ValueError('Bitmask sampling supports at most 62 options, got %d' %n_options)
+    if combo == 0 or combo >= n_options:
+        return random_state.randint(1, 2**n_options, size=n_row, dtype=np.int64)
+
+    sizes = np.arange(1, combo+1)
+    weights = np.array([_n_combinations(n_options, size) for size in sizes], dtype=float)
+    row_sizes = random_state.choice(sizes, n_row, p=weights/weights.sum())
+    masks = np.zeros(n_row, dtype=np.int64)
+    for size in np.unique(row_sizes):
+        rows = row_sizes == size
+        picked = random_state.rand(rows.sum(), n_options).argsort(axis=1)[:, :size]
+        masks[rows] = np.left_shift(np.int64(1), picked).sum(axis=1)
+    return masks
+
+def masks_to_responses(masks, options):
+    """Turns bitmask integers into comma separated responses, e.g. 'option_a, option_c'.
+    Each distinct combination is only formatted once."""
+    unique_masks, inverse = np.unique(masks, return_inverse=True)
+    bits = np.right_shift(unique_masks[:, np.newaxis], np.arange(len(options))) & 1
+    options = np.array(options, dtype=object)
+    responses = np.array([', '.join(options[row.astype(bool)]) for row in bits], dtype=object)
+    return responses[inverse]
+
 def gen_sim_data(template):
     """Generates a simulated data set as a pandas data frame from a pandas data frame template
 
-    First the user specificies how many rows of simulated data they want, then an empty data
-    frame with the same column names as the template is generated. The column names are then
-    used to determine what kind of data should be entered into the cells.
+    First the user specificies how many rows of simulated data they want, then the user is asked for
+    the settings of the multiple choice and quantity columns. The column names are then used to
+    determine what kind of data should be entered into the cells (see gen_sim_data_chunks).
     """
-    n_col = template.shape[1]
     n_row = raw_input("Please specify the desired number rows for the simulated data")
     n_row = np.int(n_row)
 
-    new_matrix = np.empty([n_row, n_col])
-    new_matrix[:, :] = np.nan
-    sim_data = pd.DataFrame(new_matrix)
-    sim_data.columns = template.columns
-
-    for column in sim_data.columns:
-        if template.loc['question_type', column] in ['binary', 'likert']:
-            options = extract_response_options(template, column)
-            sim_values = np.random.choice(options, n_row)
-            sim_data.loc[:, column] = sim_values
-        elif template.loc['question_type', column] == 'multiple_choice':
-            options = extract_response_options(template, column)
+    template = Template.compile(template)
+    config = {}
+    for question in template:
+        column = question.name
+        if question.question_type == 'multiple_choice':
             print column
             combo = raw_input('Pick max number of options')
             if combo == '':
-                combinations_list = extract_multiple_choice_combinations(options)
-            else:
-                combinations_list = extract_multiple_choice_combinations(options, int(combo))
-            sim_values = np.random.choice(combinations_list, n_row)
-            sim_data.loc[:, column] = [', '.join(value).translate(None, "()'") for value in sim_values]
-        elif template.loc['question_type', column] == 'quantity':
+                combo = 0
+            config[column] = {'combo': int(combo)}
+        elif question.question_type == 'quantity':
             print column
             quantity_mean = raw_input("Pick appropriate mean")
             quantity_sd = raw_input("Pick appropriate standard deviation")
-            quantity_mean = np.float(quantity_mean)
-            quantity_sd = np.float(quantity_sd)
-            sim_values = np.round(np.random.normal(quantity_mean, quantity_sd, n_row), 0)
-            sim_data.loc[:, column] = sim_values
-        elif template.loc['question_type', column] in ['open', 'open_few_options', 'open_list']:
-            sim_data.loc[:, column] = np.repeat('there should be text here', n_row)
+            config[column] = {'mean': np.float(quantity_mean), 'sd': np.float(quantity_sd)}
+
+    return pd.concat(gen_sim_data_chunks(template, n_row, config, chunk_size=max(n_row, 1)))
+
+def _sim_column_specs(template, config):
+    """Collects the question type, response options and settings of every template column once, so that
+    they don't have to be looked up again for every chunk"""
+    specs = []
+    missing = []
+    for question in Template.compile(template):
+        column, question_type = question.name, question.question_type
+        settings = config.get(column, {})
+        options = None
+        if question_type in ['binary', 'likert', 'multiple_choice']:
+            options = list(question.options)
+        elif question_type == 'quantity' and ('mean' not in settings or 'sd' not in settings):
+            missing.append(column)
+        specs.append((column, question_type, options, settings))
+    if missing:
+        raise ValueError('The config needs a mean and sd for the quantity columns: ' + ', '.join(missing))
+    return specs
+
+def _sim_column(question_type, options, settings, n_row, random_state):
+    """Simulates n_row values for one column"""
+    if question_type in ['binary', 'likert']:
+        codes = random_state.choice(len(options), n_row, p=settings.get('p'))
+        return pd.Categorical.from_codes(codes, options)
+    elif question_type == 'multiple_choice' and options:
+        masks = sample_multiple_choice_masks(len(options), n_row, settings.get('combo', 0), random_state)
+        return masks_to_responses(masks, options)
+    elif question_type == 'quantity':
+        return np.round(random_state.normal(settings['mean'], settings['sd'], n_row), 0)
+    elif question_type in ['open', 'open_few_options', 'open_list']:
+        return pd.Categorical.from_codes(np.zeros(n_row, dtype=int), [settings.get('text', 'there should be text here')])
+    return np.repeat(np.nan, n_row)
+
+def _column_random_state(seed, column_number, chunk_number):
+    """Returns the random stream for one column of one chunk.
+
+    Every (column, chunk) pair gets its own RandomState seeded with the key [seed, column, chunk], so the
+    values of a chunk don't depend on which process generates it, or in what order."""
+    return np.random.RandomState([seed, column_number, chunk_number])
+
+def _sim_chunk(job):
+    """Simulates one chunk of rows, used by gen_sim_data_chunks (also inside worker processes)"""
+    specs, columns, seed, chunk_number, start, rows = job
+    values = [(column, _sim_column(question_type, options, settings, rows,
+                                   _column_random_state(seed, column_number, chunk_number)))
+              for column_number, (column, question_type, options, settings) in enumerate(specs)]
+    return pd.DataFrame(dict(values), index=np.arange(start, start+rows), columns=columns)
 
-    return sim_data
+def gen_sim_data_chunks(template, n_row, config=None, chunk_size=100000, seed=None, processes=1):
+    """Generates simulated data from a template in chunks of chunk_size rows, without user input.
 
-def gen_response_sheet(template):
+    config maps columns to their settings: 'mean' and 'sd' (required) for quantity columns, 'combo' (the
+    maximum number of options, 0 for no limit) for multiple choice columns, 'p' (one probability per
+    response option) for likert and binary columns and 'text' for open columns. Likert, binary and open
+    columns are built directly as categoricals.
+
+    Every column of every chunk has its own random stream derived from seed, so with processes > 1 the
+    chunks are generated in a process pool and still match a single process run bit for bit (for the
+    same seed and chunk_size). At most processes chunks are submitted to the pool ahead of the one being
+    consumed, so memory stays bounded however many chunks there are. If no seed is given one is drawn and
+    printed, so the run can be replayed."""
+    if config is None:
+        config = {}
+    if seed is None:
+        seed = np.random.randint(0, 2**31 - 1)
+        print 'Simulation seed: %d' %seed
+    template = Template.compile(template)
+    specs = _sim_column_specs(template, config)
+    jobs = [(specs, template.names, seed, chunk_number, start, min(chunk_size, n_row - start))
+            for chunk_number, start in enumerate(range(0, n_row, chunk_size))]
+
+    if processes == 1:
+        for job in jobs:
+            yield _sim_chunk(job)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            pending = collections.deque()
+            for job in jobs:
+                pending.append(pool.apply_async(_sim_chunk, (job,)))
+                if len(pending) > processes:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.close()
+            pool.join()
+
+def write_sim_data(template, n_row, file_path, config=None, chunk_size=100000, seed=None, processes=1):
+    """Streams simulated data (see gen_sim_data_chunks) to a csv file or to an HDF5 table (.h5/.hdf),
+    one chunk at a time, so only a few chunks are held in memory."""
+    extension = file_path.rsplit('.', 1)[-1].lower()
+    if extension not in ['csv', 'h5', 'hdf']:
+        raise ValueError('Simulated data can only be written to csv or HDF5 (.h5, .hdf) files')
+    if config is None:
+        config = {}
+    template = Template.compile(template)
+
+    # HDF5 tables fix the width of text columns when the first chunk is written
+    min_itemsize = {}
+    for column, question_type, options, settings in _sim_column_specs(template, config):
+        if question_type == 'multiple_choice':
+            min_itemsize[column] = len(', '.join(options))
+
+    store = pd.HDFStore(file_path, mode='w') if extension != 'csv' else None
+    try:
+        chunks = gen_sim_data_chunks(template, n_row, config, chunk_size, seed, processes)
+        for chunk_number, chunk in enumerate(chunks):
+            if store is None:
+                chunk.to_csv(file_path, index=False, header=chunk_number == 0,
+                             mode='w' if chunk_number == 0 else 'a')
+            else:
+                store.append('sim_data', chunk, format='table', min_itemsize=min_itemsize)
+    finally:
+        if store is not None:
+            store.close()
+
+def _response_sheet_columns(template, combos, max_combinations=None):
+    """Returns an iterator of permitted responses for every column of the response sheet.
+
+    combos maps multiple choice columns to the maximum number of options in a combination (0 for no
+    limit), max_combinations caps the number of combinations listed for a single question."""
+    columns = []
+    for question in Template.compile(template):
+        if question.question_type in ['binary', 'likert']:
+            values = iter(question.options)
+        elif question.question_type == 'multiple_choice':
+            values = iter_multiple_choice_combinations(list(question.options), combos.get(question.name, 0))
+            if max_combinations is not None:
+                values = it.islice(values, max_combinations)
+        elif question.question_type == 'quantity':
+            values = iter(['number'])
+        elif question.question_type == 'date':
+            values = iter(['date, format: day-month-year'])
+        elif question.question_type == 'time':
+            values = iter(['time, format: hour:minutes'])
+        else:
+            values = iter(['text'])
+        columns.append(values)
+    return columns
+
+def gen_response_sheet(template, max_combinations=None):
     """Generates a response sheet as a pandas data frame from a pandas data frame template
 
     The response sheet is simply a data frame with the questions as column names and the permitted response
     alternatives as rows inside the appropriate columns. It is automatically generated from the template
-    data frame."""
-    n_col = template.shape[1]
-    n_row = 1
-    for column in template.columns:
-        if template.loc['question_type', column] in ['binary', 'likert']:
-            options = extract_response_options(template, column)
-            if len(options) > n_row:
-                n_row = len(options)
-        elif template.loc['question_type', column] == 'multiple_choice':
-            options = extract_response_options(template, column)
-            print column
-            combo = raw_input('Pick max number of options')
-            if combo == '':
-                combinations_list = extract_multiple_choice_combinations(options)
-            else:
-                combinations_list = extract_multiple_choice_combinations(options, int(combo))
-            if len(combinations_list) > n_row:
-                n_row = len(combinations_list)
-
-    new_matrix = np.empty([n_row, n_col])
-    new_matrix[:, :] = np.nan
-    response_sheet = pd.DataFrame(new_matrix)
-    response_sheet.columns = template.columns
-
-    for column in response_sheet.columns:
-        if template.loc['question_type', column] in ['binary', 'likert']:
-            options = extract_response_options(template, column)
-            row = 0
-            for option in options:
-                response_sheet.loc[row, column] = option
-                row +=1
-        elif template.loc['question_type', column] == 'multiple_choice':
-            options = extract_response_options(template, column)
-            row = 0
-            combinations_list = extract_multiple_choice_combinations(options)
-
-            for option in combinations_list:
-                response_sheet.loc[row, column] = ', '.join(option).translate(None, "()'")
-                row +=1
-        elif template.loc['question_type', column] == 'quantity':
-            response_sheet.loc[0, column] = 'number'
-        elif template.loc['question_type', column] == 'date':
-            response_sheet.loc[0, column] = 'date, format: day-month-year'
-        elif template.loc['question_type', column] == 'time':
-            response_sheet.loc[0, column] = 'time, format: hour:minutes'
-        else:
-            response_sheet.loc[0, column] = 'text'
+    data frame. max_combinations caps the number of multiple choice combinations listed per question."""
+    template = Template.compile(template)
+    combos = {}
+    for question in template.of_type('multiple_choice'):
+        print question.name
+        combo = raw_input('Pick max number of options')
+        if combo != '':
+            combos[question.name] = int(combo)
 
+    columns = _response_sheet_columns(template, combos, max_combinations)
+    response_sheet = pd.DataFrame(dict([(column, pd.Series(list(values)))
+                                        for column, values in zip(template.names, columns)]),
+                                  columns=template.names)
     return response_sheet
 
+def write_response_sheet(template, file_path, combos=None, max_combinations=None):
+    """Writes a response sheet straight to a csv file without building it in memory first.
+
+    Multiple choice combinations are generated lazily while the rows are written, so large multiple
+    choice questions can be listed in full. combos maps multiple choice columns to the maximum number of
+    options in a combination, max_combinations caps the number of combinations per question."""
+    if combos is None:
+        combos = {}
+    template = Template.compile(template)
+    columns = _response_sheet_columns(template, combos, max_combinations)
+    with open(file_path, 'wb') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(template.names)
+        for row in it.izip_longest(*columns, fillvalue=''):
+            writer.writerow(row)
+
 def gen_examples_from_template():
     """Wrapper that loads the template, uses the template to generate the simulated data and the response sheet
     and and saves the simulated data and the response sheet to a location the user specifies. """
@@ -152,4 +313,5 @@ def gen_examples_from_template():
     sim_data.to_csv(sim_data_path, index=False)
     response_sheet.to_csv(response_sheet_path, index=False)
 
-gen_examples_from_template()
+if __name__ == '__main__':
+    gen_examples_from_template()
@@ -16,6 +16,27 @@ __author__ = 'Tomas Folke'
 import numpy as np
 import pandas as pd
 import os
+import re
+import sys
+import json
+import hashlib
+
+# the punctuation that is stripped from raw questions when they are turned into question labels
+LABEL_PUNCTUATION_PATTERN = re.compile('[_.,:!?]')
+# part of the Template.load cache key, increase it whenever the parsing of Question records changes
+TEMPLATE_CACHE_VERSION = 2
+TEMPLATE_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.gt_template_cache')
+QUESTIONNAIRE_SECTIONS = {'D': 'demographic_data', 'A': 'collection_info', 'Q': 'main_questions'}
+QUESTION_TYPES = {1:'open', 2:'open_few_options', 3:'open_list', 4:'quantity', 5:'multiple_choice',
+                  6:'likert', 7:'binary' , 8:'date', 9:'time', 10:'other'}
+BINARY_OPTIONS = {1:['1_no', '2_yes', '3_dont_know', '4_dont_want_to_answer'],
+                  2:['1_yes', '2_no', '3_dont_know', '4_dont_want_to_answer'],
+                  3:['1_female', '2_male', '3_other'], 4:['Other']}
+LIKERT_OPTIONS = {1:['1_not_at_all', '2_slightly', '3_moderately', '4_mostly', '5_completely', '6_dont_know', '7_dont_want_to_answer'],
+                  2:['1_completely', '2_mostly', '3_moderately', '4_slightly', '5_not_at_all', '6_dont_know', '7_dont_want_to_answer'],
+                  3:['1_never', '2_rarely', '3_sometimes', '4_most_of_the_time', '5_always', '6_dont_know', '7_dont_want_to_answer'],
+                  4:['1_always', '2_most_of_the_time', '3_sometimes', '4_rarely', '5_never', '6_dont_know', '7_dont_want_to_answer'],
+                  5:['Other']}
 
 def input_response_option(options_dict):
     """This function allows the user to select an alternative from a dictionary of options.
@@ -68,7 +89,7 @@ def input_question_info():
             done = True
             break
         
-        question = question.translate(None, "_.,:!?")
+        question = LABEL_PUNCTUATION_PATTERN.sub('', question)
         question = question.lower()
         question = '_'.join(question.split())
 
@@ -96,54 +117,29 @@ def input_question_info():
 
             print section_list[question_counter]
 
-            question_types = {1:'open', 2:'open_few_options', 3:'open_list',
-                4:'quantity', 5:'multiple_choice',
-                          6:'likert', 7:'binary' , 8:'date', 9:'time', 10:'other'}
-
             # Assign some question types automatically, based on keywords in the question names.
-            if not question.startswith('Q') and 'sex' in question.split('_'):
-                question_type_list.append('binary')
-            elif not question.startswith('Q') and 'name' in question.split('_'):
-                question_type_list.append('open')
-            elif question.startswith('A') and 'time' in question.split('_'):
-                question_type_list.append('time')
-            elif question.startswith('A') and 'date' in question.split('_'):
-                question_type_list.append('date')
-            elif not question.startswith('Q') and any([word in set(question.split('_')) for word in ['region', 'zone', 'woreda',
-                                            'camp', 'division', 'kakuma', 'block']]):
-                question_type_list.append('open_few_options')
-            elif question.startswith('Q') and question.split('_')[0][-1] == 'b':
-                question_type_list.append('open')
-
-            else:
-                response = input_response_option(question_types)
-
-                print question_types[response]
-                question_type_list.append(question_types[response])
+            question_type = infer_question_type(question)
+            if question_type is None:
+                response = input_response_option(QUESTION_TYPES)
 
-            binary_options_dict = {1:['1_no', '2_yes', '3_dont_know', '4_dont_want_to_answer'],
-                                   2:['1_yes', '2_no', '3_dont_know', '4_dont_want_to_answer'],
-                                   3:['1_female', '2_male', '3_other'], 4:['Other']}
-            likert_options_dict = {1:['1_not_at_all', '2_slightly', '3_moderately', '4_mostly', '5_completely', '6_dont_know', '7_dont_want_to_answer'],
-                                   2:['1_completely', '2_mostly', '3_moderately', '4_slightly', '5_not_at_all', '6_dont_know', '7_dont_want_to_answer'],
-                                     3: ['1_never', '2_rarely', '3_sometimes', '4_most_of_the_time', '5_always', '6_dont_know', '7_dont_want_to_answer'],
-                                     4: ['1_always', '2_most_of_the_time', '3_sometimes', '4_rarely', '5_never', '6_dont_know', '7_dont_want_to_answer'],
-                                        5:['Other']}
+                print QUESTION_TYPES[response]
+                question_type = QUESTION_TYPES[response]
+            question_type_list.append(question_type)
 
             # Assign response options to binary questions
             if question_type_list[question_counter] == 'binary':
                 # If the question contains the words 'sex' or 'gender' assign gender response options
                 if not question.startswith('Q') and any([word in set(question.split('_')) for word in ['sex', 'gender']]):
-                    response_options_list.append(['1_female', '2_male', '3_other'])
+                    response_options_list.append(BINARY_OPTIONS[3])
                 # otherwise let the user pick a response option
                 else:
-                    response = input_response_option(binary_options_dict)
-                    response_options_list.append(binary_options_dict[response])
+                    response = input_response_option(BINARY_OPTIONS)
+                    response_options_list.append(BINARY_OPTIONS[response])
 
             # Let the user manually assign response options to likert scale questions
             elif question_type_list[question_counter] == 'likert':
-                response = input_response_option(likert_options_dict)
-                response_options_list.append(likert_options_dict[response])
+                response = input_response_option(LIKERT_OPTIONS)
+                response_options_list.append(LIKERT_OPTIONS[response])
 
             # If the question is an open list create one column per possible list entry
             elif question_type_list[question_counter] == 'open_list':
@@ -230,7 +226,7 @@ def experimental_input_question_info():
        # Once all questions have been added, return the question labels and the information about
        # the questions.
     for question in contents:
-    	question = question.translate(None, "_.,:!?")
+    	question = LABEL_PUNCTUATION_PATTERN.sub('', question)
     	question = question.lower()
     	question = '_'.join(question.split())
     	
@@ -259,49 +255,27 @@ def experimental_input_question_info():
     	question_list.append(question)
     	hxl_tags.append(np.nan)
     	
-    	question_types = {1:'open', 2:'open_few_options', 3:'open_list',
-               4:'quantity', 5:'multiple_choice',
-                         6:'likert', 7:'binary' , 8:'date', 9:'time', 10:'other'}
            # Assign some question types automatically, based on keywords in the question names.
-    	if not question.startswith('Q') and 'sex' in question.split('_'):
-    		question_type_list.append('binary')
-    	elif not question.startswith('Q') and 'name' in question.split('_'):
-    		question_type_list.append('open')
-    	elif question.startswith('A') and 'time' in question.split('_'):
-    		question_type_list.append('time')
-    	elif question.startswith('A') and 'date' in question.split('_'):
-    		question_type_list.append('date')
-    	elif not question.startswith('Q') and any([word in set(question.split('_')) for word in ['region', 'zone', 'woreda',
-                                           'camp', 'division', 'kakuma', 'block']]):
-    		question_type_list.append('open_few_options')
-    	elif question.startswith('Q') and question.split('_')[0][-1] == 'b':
-    		question_type_list.append('open')
-    	else:
-    		response = input_response_option(question_types)
+    	question_type = infer_question_type(question)
+    	if question_type is None:
+    		response = input_response_option(QUESTION_TYPES)
     		
-    		print question_types[response]
-    		question_type_list.append(question_types[response])
-    	binary_options_dict = {1:['1_no', '2_yes', '3_dont_know', '4_dont_want_to_answer'],
-                                  2:['1_yes', '2_no', '3_dont_know', '4_dont_want_to_answer'],
-                                  3:['1_female', '2_male', '3_other'], 4:['Other']}
-    	likert_options_dict = {1:['1_not_at_all', '2_slightly', '3_moderately', '4_mostly', '5_completely', '6_dont_know', '7_dont_want_to_answer'],
-                                  2:['1_completely', '2_mostly', '3_moderately', '4_slightly', '5_not_at_all', '6_dont_know', '7_dont_want_to_answer'],
-                                    3: ['1_never', '2_rarely', '3_sometimes', '4_most_of_the_time', '5_always', '6_dont_know', '7_dont_want_to_answer'],
-                                    4: ['1_always', '2_most_of_the_time', '3_sometimes', '4_rarely', '5_never', '6_dont_know', '7_dont_want_to_answer'],
-                                       5:['Other']}
+    		print QUESTION_TYPES[response]
+    		question_type = QUESTION_TYPES[response]
+    	question_type_list.append(question_type)
            # Assign response options to binary questions
     	if question_type_list[question_counter] == 'binary':
     		# If the question contains the words 'sex' or 'gender' assign gender response options
     		if not question.startswith('Q') and any([word in set(question.split('_')) for word in ['sex', 'gender']]):
-    			response_options_list.append(['1_female', '2_male', '3_other'])
+    			response_options_list.append(BINARY_OPTIONS[3])
                # otherwise let the user pick a response option
     		else:
-    			response = input_response_option(binary_options_dict)
-    			response_options_list.append(binary_options_dict[response])
+    			response = input_response_option(BINARY_OPTIONS)
+    			response_options_list.append(BINARY_OPTIONS[response])
            # Let the user manually assign response options to likert scale questions
     	elif question_type_list[question_counter] == 'likert':
-    		response = input_response_option(likert_options_dict)
-    		response_options_list.append(likert_options_dict[response])
+    		response = input_response_option(LIKERT_OPTIONS)
+    		response_options_list.append(LIKERT_OPTIONS[response])
            # If the question is an open list create one column per possible list entry
     	elif question_type_list[question_counter] == 'open_list':
     		response = raw_input('How many instances does the list have?')
@@ -329,20 +303,280 @@ def experimental_input_question_info():
     	question_counter += 1
     return [question_list, hxl_tags, section_list, question_type_list, response_options_list]
 
-def create_template():
+def format_question_label(question):
+    """Reformats a raw question into a GT question label, e.g. 'q1. Are you safe?' -> 'Q1_are_you_safe'.
+    Returns None if the question does not start with one of the section prefixes d, a or q."""
+    question = LABEL_PUNCTUATION_PATTERN.sub('', question)
+    question = question.lower()
+    question = '_'.join(question.split())
+    if question == '' or question[0].upper() not in QUESTIONNAIRE_SECTIONS:
+        return None
+    return question[0].upper() + question[1:]
+
+def infer_question_type(question):
+    """Assigns a question type based on keywords in a question label (used by input_question_info and
+    the other template builders). Returns None if no keyword rule applies."""
+    words = set(question.split('_'))
+    if not question.startswith('Q') and 'sex' in words:
+        return 'binary'
+    elif not question.startswith('Q') and 'name' in words:
+        return 'open'
+    elif question.startswith('A') and 'time' in words:
+        return 'time'
+    elif question.startswith('A') and 'date' in words:
+        return 'date'
+    elif not question.startswith('Q') and any([word in words for word in ['region', 'zone', 'woreda',
+                                                'camp', 'division', 'kakuma', 'block']]):
+        return 'open_few_options'
+    elif question.startswith('Q') and question.split('_')[0][-1] == 'b':
+        return 'open'
+    return None
+
+def read_questionnaire(questionnaire_path):
+    """Reads a questionnaire from a csv, xlsx or json file into a data frame with a 'question' column.
+
+    Json questionnaires can either be a list of questions or a list of records with the same fields as
+    the csv and xlsx columns."""
+    extension = os.path.splitext(questionnaire_path)[1].lower()
+    if extension == '.csv':
+        questionnaire = pd.read_csv(questionnaire_path)
+    elif extension in ['.xlsx', '.xls']:
+        questionnaire = pd.read_excel(questionnaire_path)
+    elif extension == '.json':
+        with open(questionnaire_path) as questionnaire_file:
+            records = json.load(questionnaire_file)
+        if all([isinstance(record, basestring) for record in records]):
+            records = [{'question': record} for record in records]
+        questionnaire = pd.DataFrame(records)
+    else:
+        raise ValueError('Questionnaires must be csv, xlsx or json files, got ' + questionnaire_path)
+    if 'question' not in questionnaire.columns:
+        raise ValueError(questionnaire_path + " has no 'question' column")
+    return questionnaire
+
+def _hint(row, field):
+    """Returns a hint from a questionnaire row, or None if the field is missing or empty"""
+    value = row.get(field)
+    if value is None or value != value or value == '':
+        return None
+    return value
+
+def questionnaire_question_info(questionnaire_path):
+    """Generates the same lists as input_question_info from a questionnaire file, without any user input.
+
+    The questionnaire has a 'question' column and optional hint columns: 'question_type' (a type name
+    such as 'likert', or its number in QUESTION_TYPES), 'response_options' (the number of an option set in
+    BINARY_OPTIONS or LIKERT_OPTIONS) and 'list_instances' (the number of columns for open_list questions).
+    Questions without a type hint are typed with the keyword rules of input_question_info, and gender
+    questions get gender response options. Raises a ValueError listing every question that can't be
+    resolved without a hint."""
+    questionnaire = read_questionnaire(questionnaire_path)
+    question_list = []
+    section_list = []
+    question_type_list = []
+    response_options_list = []
+    hxl_tags = []
+    problems = []
+
+    for row in questionnaire.to_dict(orient='records'):
+        if _hint(row, 'question') is None:
+            continue
+        question = format_question_label(row['question'])
+        if question is None:
+            problems.append('Does not recognise question format: %s' %row['question'])
+            continue
+        section = QUESTIONNAIRE_SECTIONS[question[0]]
+
+        question_type = _hint(row, 'question_type')
+        if question_type is None:
+            question_type = infer_question_type(question)
+        elif not isinstance(question_type, basestring) or question_type.isdigit():
+            question_type = QUESTION_TYPES.get(np.int(question_type))
+        if question_type not in QUESTION_TYPES.values():
+            problems.append('No valid question type for %s' %question)
+            continue
+
+        options_hint = _hint(row, 'response_options')
+        if question_type == 'binary' and options_hint is None and not question.startswith('Q') and any(
+                [word in set(question.split('_')) for word in ['sex', 'gender']]):
+            response_options = BINARY_OPTIONS[3]
+        elif question_type in ['binary', 'likert']:
+            options_dict = BINARY_OPTIONS if question_type == 'binary' else LIKERT_OPTIONS
+            if options_hint is None or np.int(options_hint) not in options_dict:
+                problems.append('No valid response options for %s' %question)
+                continue
+            response_options = options_dict[np.int(options_hint)]
+        else:
+            response_options = question_type
+
+        labels = [question]
+        instances = _hint(row, 'list_instances')
+        if question_type == 'open_list' and instances is not None and np.int(instances) > 1:
+            words = question.split('_')
+            labels = ['_'.join([words[0] + '-%d' %i] + words[1:]) for i in range(1, np.int(instances)+1)]
+
+        for label in labels:
+            question_list.append(label)
+            hxl_tags.append(np.nan)
+            section_list.append(section)
+            question_type_list.append(question_type)
+            response_options_list.append(response_options)
+
+    if problems:
+        raise ValueError(questionnaire_path + ':\n' + '\n'.join(problems))
+    return [question_list, hxl_tags, section_list, question_type_list, response_options_list]
+
+def create_template(questionnaire_path=None, file_path=None):
     """ Wrapping function to create the template and save it as a csv file.
 
-    Runs the input_question_function, use the output to create a pandas data frame.
-    Saves the data frame where the user specifies.
+    Without a questionnaire_path the question information is entered interactively (see
+    input_question_info), otherwise it is read from the questionnaire file (see
+    questionnaire_question_info). Saves the data frame to file_path, or where the user specifies.
     """
 
-    question_info = input_question_info()
+    if questionnaire_path is None:
+        question_info = input_question_info()
+    else:
+        question_info = questionnaire_question_info(questionnaire_path)
 
     template = pd.DataFrame(question_info[1:], columns=question_info[0])
 
     template.index = ['HXL_tag', 'question_section', 'question_type', 'response_options']
 
-    file_path = get_file_path()
+    if file_path is None:
+        file_path = get_file_path()
     template.to_csv(file_path)
-
-create_template()
+    return template
+
+def create_templates(questionnaire_paths, folder_path):
+    """Creates one template per questionnaire file in folder_path, named <questionnaire>_template.csv"""
+    for questionnaire_path in questionnaire_paths:
+        name = os.path.splitext(os.path.basename(questionnaire_path))[0]
+        create_template(questionnaire_path, os.path.join(folder_path, name + '_template.csv'))
+
+def parse_response_options(response_options):
+    """Transforms the response options of a template cell from a stringified list to a list"""
+    if isinstance(response_options, (list, tuple)):
+        return list(response_options)
+    return response_options.translate(None, "[]',").split()
+
+def _option_code(option):
+    """The number at the beginning of a response option (e.g. 2 for '2_yes'), NaN if there is none"""
+    prefix = option.split('_')[0]
+    return np.float(prefix) if prefix.isdigit() else np.nan
+
+class Question(object):
+    """The template information of one question, with its response options parsed.
+
+    codes are the numbers at the beginning of the response options (NaN if an option has none) and
+    colour_keys the integer keys of the likert and binary colour palettes (None for other questions)."""
+    __slots__ = ('name', 'hxl_tag', 'section', 'question_type', 'options', 'codes', 'colour_keys')
+
+    def __init__(self, name, hxl_tag, section, question_type, response_options):
+        self.name = name
+        self.hxl_tag = hxl_tag
+        self.section = section
+        self.question_type = question_type
+        # create_template writes the question type as placeholder response options of multiple choice questions
+        if (question_type in ['likert', 'binary', 'multiple_choice'] and isinstance(response_options, (basestring, list, tuple))
+                and response_options != question_type):
+            self.options = tuple(parse_response_options(response_options))
+        else:
+            self.options = ()
+        self.codes = tuple([_option_code(option) for option in self.options])
+        if question_type in ['likert', 'binary'] and self.options and not np.isnan(self.codes).any():
+            self.colour_keys = tuple([int(code) for code in self.codes])
+        else:
+            self.colour_keys = None
+
+    def __repr__(self):
+        return 'Question(%r, %r, %r)' %(self.name, self.question_type, self.options)
+
+class Template(object):
+    """A template parsed once into Question records, in the order of the template columns.
+
+    Template.load reads a template csv file and keeps the parsed template in a cache file in the user's
+    TEMPLATE_CACHE_DIR, keyed on the md5 hash of the csv and TEMPLATE_CACHE_VERSION, so an unchanged
+    template is only parsed once by the same parsing code.
+    Template.compile turns a template data frame in either orientation (as written by create_template,
+    or transposed) into a Template, and passes Templates through, so functions can accept both."""
+
+    def __init__(self, questions):
+        self.questions = list(questions)
+        self._questions = dict([(question.name, question) for question in self.questions])
+
+    @property
+    def names(self):
+        return [question.name for question in self.questions]
+
+    def __getitem__(self, name):
+        return self._questions[name]
+
+    def __contains__(self, name):
+        return name in self._questions
+
+    def __iter__(self):
+        return iter(self.questions)
+
+    def __len__(self):
+        return len(self.questions)
+
+    def of_type(self, *question_types):
+        """The questions of the given question types"""
+        return [question for question in self.questions if question.question_type in question_types]
+
+    @classmethod
+    def from_frame(cls, template):
+        """Parses a template data frame, either as written by create_template (one column per question)
+        or transposed (one row per question)"""
+        if 'question_type' not in template.index:
+            template = template.transpose()
+        return cls([Question(name, template.loc['HXL_tag', name] if 'HXL_tag' in template.index else np.nan,
+                             template.loc['question_section', name] if 'question_section' in template.index else np.nan,
+                             template.loc['question_type', name], template.loc['response_options', name])
+                    for name in template.columns])
+
+    @classmethod
+    def compile(cls, template):
+        """Returns template if it already is a Template, otherwise parses it with from_frame"""
+        if isinstance(template, cls):
+            return template
+        return cls.from_frame(template)
+
+    @classmethod
+    def load(cls, file_path, cache=True, cache_dir=None):
+        """Loads a template csv file, from its cache file if the csv has not changed since it was cached.
+
+        Cache files are pickles, and loading a pickle can run arbitrary code, so they are kept in a
+        directory of the current user (TEMPLATE_CACHE_DIR unless cache_dir is given) rather than next to
+        the csv, which may be in a shared folder. Only point cache_dir to a directory you trust."""
+        with open(file_path, 'rb') as template_file:
+            file_hash = hashlib.md5(template_file.read()).hexdigest()
+        if cache_dir is None:
+            cache_dir = TEMPLATE_CACHE_DIR
+        cache_path = os.path.join(cache_dir, '%s-v%d.pickle' %(file_hash, TEMPLATE_CACHE_VERSION))
+        if cache and os.path.exists(cache_path):
+            return pd.read_pickle(cache_path)
+
+        template = cls.from_frame(pd.read_csv(file_path, header=0, index_col=0))
+        if cache:
+            try:
+                if not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                pd.to_pickle(template, cache_path)
+            except (IOError, OSError):
+                print 'Could not write the template cache to', cache_path
+        return template
+
+    def to_frame(self, transposed=False):
+        """The template as a data frame, as create_template writes it or transposed"""
+        frame = pd.DataFrame(dict([(question.name, [question.hxl_tag, question.section, question.question_type,
+                                                    str(list(question.options)) if question.options else np.nan])
+                                   for question in self.questions]),
+                             index=['HXL_tag', 'question_section', 'question_type', 'response_options'],
+                             columns=self.names)
+        return frame.transpose() if transposed else frame
+
+if __name__ == '__main__':
+    # python gen_templates.py [questionnaire_file [template_file]]
+    create_template(*sys.argv[1:3])
@@ -15,49 +15,216 @@ __version__ = '0.1'
 __author__ = 'Tomas Folke'
 
 # Import libraries
+import os
+import re
+import collections
+import time
+import traceback
+import multiprocessing
 import numpy as np
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from data_cleaning import normalize_text, parse_response_options, parse_multiple_choice, unpack_multiple_choice
+from data_cleaning import DONT_KNOW_RESPONSES, response_numbers
+from gen_templates import Template
+
+# Export profiles for export_figure. Each profile maps a file format to its settings, formats that are
+# missing from a profile are skipped (e.g. 'draft' only writes vector output). 'poster' matches the
+# 600 dpi output the draw functions have always written.
+EXPORT_PROFILES = {
+    'poster': {'pdf': {'dpi': 600}, 'jpg': {'dpi': 600, 'quality': 95}, 'png': {'dpi': 600, 'compress_level': 6}},
+    'report': {'pdf': {'dpi': 600}, 'jpg': {'dpi': 200, 'quality': 85}, 'png': {'dpi': 200, 'compress_level': 6}},
+    'web': {'jpg': {'dpi': 96, 'quality': 80}, 'png': {'dpi': 96, 'compress_level': 9}},
+    'draft': {'pdf': {'dpi': 600}},
+}
+DEFAULT_EXPORT_PROFILE = 'poster'
+
+# GT colours for response options, keyed by the number the option starts with (e.g. 2 for '2_yes')
+LIKERT_COLOURS = {1: "#f19891", 2: "#f8cac3", 3:"#e9ecf0", 4:"#b2cfb3", 5:"#4aa168", 6:"#c9d5dd", 7:'#9bb2bf'}
+BINARY_COLOURS = {1: "#f19891", 2: "#4aa168", 3: "#c9d5dd", 4: '#9bb2bf'}
+
+# colours by (likert, response option) and the rcParams of the last style use_style applied
+_LABEL_COLOURS = {}
+_ACTIVE_STYLE = {}
+
+def _render_rgba(fig, dpi):
+    """Draws a figure once with the Agg renderer and returns its pixels as an RGBA array.
+
+    The figure and axes backgrounds are made transparent while drawing, like savefig(transparent=True)."""
+    original_canvas = fig.canvas
+    original_dpi = fig.dpi
+    patches = [fig.patch] + [ax.patch for ax in fig.axes]
+    original_colours = [(patch.get_facecolor(), patch.get_edgecolor()) for patch in patches]
+    try:
+        for patch in patches:
+            patch.set_facecolor('none')
+            patch.set_edgecolor('none')
+        fig.dpi = dpi
+        canvas = FigureCanvasAgg(fig)
+        canvas.draw()
+        width, height = canvas.get_width_height()
+        pixels = np.frombuffer(canvas.buffer_rgba(), np.uint8).reshape(height, width, 4).copy()
+    finally:
+        for patch, (facecolor, edgecolor) in zip(patches, original_colours):
+            patch.set_facecolor(facecolor)
+            patch.set_edgecolor(edgecolor)
+        fig.dpi = original_dpi
+        fig.set_canvas(original_canvas)
+    return pixels
+
+def _write_raster(pixels, file_path, file_format, settings):
+    """Encodes an RGBA array as a jpg (composited on white) or png file, with Pillow"""
+    from PIL import Image
+
+    image = Image.fromarray(pixels, 'RGBA')
+    dpi = (settings['dpi'], settings['dpi'])
+    if file_format in ['jpg', 'jpeg']:
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[3])
+        background.save(file_path, 'JPEG', quality=settings.get('quality', 95), dpi=dpi)
+    else:
+        image.save(file_path, 'PNG', compress_level=settings.get('compress_level', 6), dpi=dpi)
+
+def export_figure(fig, file_stem, formats=('pdf', 'jpg'), profile=DEFAULT_EXPORT_PROFILE):
+    """Saves a figure in several formats using one of the EXPORT_PROFILES (or a profile dictionary).
+
+    Vector formats are written with savefig. Raster formats are drawn once per dpi and every raster
+    file at that dpi is encoded from the same render. Formats missing from the profile are skipped."""
+    if isinstance(profile, basestring):
+        profile = EXPORT_PROFILES[profile]
+
+    raster_formats = {}
+    for file_format in formats:
+        if file_format not in profile:
+            continue
+        settings = profile[file_format]
+        if file_format in ['pdf', 'svg', 'eps']:
+            fig.savefig(file_stem + '.' + file_format, dpi=settings.get('dpi', 600), transparent=True)
+        else:
+            raster_formats.setdefault(settings['dpi'], []).append(file_format)
+
+    for dpi, file_formats in raster_formats.items():
+        pixels = _render_rgba(fig, dpi)
+        for file_format in file_formats:
+            _write_raster(pixels, file_stem + '.' + file_format, file_format, profile[file_format])
+
+def mm2inch(value):
+    """Converts millimetres to inches, for figure sizes given in mm"""
+    return value/25.4
+
+def _label_colour(label, likert=True):
+    """Returns the GT colour of one response option, resolved once per (likert, label) and cached"""
+    key = (likert == True, label)
+    if key not in _LABEL_COLOURS:
+        colour_dict = LIKERT_COLOURS if likert == True else BINARY_COLOURS
+        _LABEL_COLOURS[key] = sns.color_palette([colour_dict[np.int(str(label).split('_')[0])]])[0]
+    return _LABEL_COLOURS[key]
+
+def response_palette(labels, likert=True):
+    """Returns the GT colours of a set of response options, from the likert or the binary colours. The
+    colour of every response option is resolved once and reused by all later plots, whichever of the
+    options a table has."""
+    return sns.color_palette([_label_colour(label, likert) for label in labels])
+
+def register_template_palettes(template):
+    """Resolves the colours of the response options of all likert and binary questions of a template up
+    front, from the colour keys gen_templates.Template has parsed"""
+    for question in Template.compile(template).of_type('likert', 'binary'):
+        if question.colour_keys is not None:
+            likert = question.question_type == 'likert'
+            colour_dict = LIKERT_COLOURS if likert else BINARY_COLOURS
+            colours = sns.color_palette([colour_dict[key] for key in question.colour_keys])
+            for option, colour in zip(question.options, colours):
+                _LABEL_COLOURS[(likert, option)] = colour
+
+def use_style(style='white', font_scale=1):
+    """Same as sns.set(style=style, font_scale=font_scale), but skipped if that style is already set and
+    the rcParams have not been changed since"""
+    key = (style, font_scale)
+    if _ACTIVE_STYLE.get('key') == key and plt.rcParams == _ACTIVE_STYLE['rc']:
+        return
+    sns.set(style=style, font_scale=font_scale)
+    _ACTIVE_STYLE['key'] = key
+    _ACTIVE_STYLE['rc'] = dict(plt.rcParams)
+
+def add_cumulative_frequencies(table, group_columns=None, round_percent=False):
+    """Adds percent, cum_frequency and cum_proportion columns to a frequency table.
+
+    The table needs a 'frequency' column and should already be sorted by response within each group.
+    If group_columns are given the statistics are computed separately for every group (e.g. every
+    breakdown category) with a single groupby, otherwise they are computed over the whole table."""
+    if group_columns:
+        grouped = table.groupby(group_columns, sort=False)['frequency']
+        totals = grouped.transform('sum').astype(float)
+        table['percent'] = table['frequency']/totals*100
+        table['cum_frequency'] = grouped.cumsum()
+    else:
+        totals = np.float(table['frequency'].sum())
+        table['percent'] = table['frequency']/totals*100
+        table['cum_frequency'] = table['frequency'].cumsum()
+    if round_percent:
+        table['percent'] = np.round(table['percent'])
+    table['cum_proportion'] = table['cum_frequency']/totals
+    return table
 
 def gen_summary_table(data, question):
     """Generates summary tables for a question, including frequencies percentages and cumulative frequencies"""
-    table = data[question].value_counts(sort=False)
-    table = pd.DataFrame(table)
-    table = table.reset_index()
-    table.columns = [question, 'frequency']
-    if question.split('_')[0] != 'quantiles':
-        table = table.sort_values(by=question, ascending=True)
-    table = table.reset_index(drop=True)
-    table['percent'] = table['frequency']
-    table['cum_frequency'] = table['frequency']
-    for index in table.index:
-        if index > 0:
-            table.loc[index, 'cum_frequency'] = table.loc[index, 'frequency'] + table.loc[index-1, 'cum_frequency']
-    table['percent'] = table['percent']/table.loc[table.shape[0]-1, 'cum_frequency']
-    table['percent'] = np.round(table['percent']*100)
-    table['cum_proportion'] = table['cum_frequency']/table.loc[table.shape[0]-1, 'cum_frequency']
-    return table
+    codes, categories = _response_codes(data[question])
+    counts = _count_responses(codes, len(categories))[0]
+    return _summary_table_from_counts(question, categories, counts)
 
-def draw_basic_plot(table, likert=True):
-    """Generates and saves standard GT bar plots from summary tables of likert questions and binary questions."""
-    sns.set(style='white')
+def _summary_plot_table(table):
+    """Turns a summary table into the table the summary bar plots are drawn from"""
     table2 = table.set_index(table.columns[0])
     table2 = table2.transpose()
     table2.loc['', :] = np.zeros(len(table2.columns))
-
-    if likert == True:
-        likert_dict ={1: "#f19891", 2: "#f8cac3", 3:"#e9ecf0", 4:"#b2cfb3", 5:"#4aa168", 6:"#c9d5dd", 7:'#9bb2bf'}
-        likert_keys = [np.int(label.split('_')[0]) for label in table2.columns]
-        likert_colours = sns.color_palette([likert_dict[x] for x in likert_keys])
-        colours = likert_colours
-    else:
-        binary_dict = {1: "#f19891", 2: "#4aa168", 3: "#c9d5dd", 4: '#9bb2bf'}
-        binary_keys = [np.int(label.split('_')[0]) for label in table2.columns]
-        binary_colours = sns.color_palette([binary_dict[x] for x in binary_keys])
-        colours = binary_colours
-
-    fig, ax = plt.subplots(figsize=(7.5, 1))
+    return table2
+
+def _stacked_bar_starts(values):
+    """Left edges of the bars of a stacked bar plot of a rows x columns array, as pandas places them
+    (bars that are not positive start at the negative stack, i.e. at 0)"""
+    starts = np.zeros(values.shape)
+    pos_prior = np.zeros(len(values))
+    neg_prior = np.zeros(len(values))
+    for column in range(values.shape[1]):
+        y = values[:, column]
+        mask = y > 0
+        starts[:, column] = np.where(mask, pos_prior, neg_prior)
+        pos_prior = pos_prior + np.where(mask, y, 0)
+        neg_prior = neg_prior + np.where(mask, 0, y)
+    return starts
+
+def _update_stacked_bars(bars, values, colours):
+    """Moves, resizes and recolours the bars of a stacked bar plot in place. bars are in the order pandas
+    draws them (column by column) and values is the rows x columns array of bar widths."""
+    starts = _stacked_bar_starts(values)
+    n_rows = len(values)
+    for index, bar in enumerate(bars):
+        column, row = divmod(index, n_rows)
+        bar.set_x(starts[row, column])
+        bar.set_width(values[row, column])
+        bar.set_facecolor(colours[column])
+
+def _update_bar_labels(bars, labels):
+    """Puts the percentage of every bar above it, the labels of empty bars are hidden"""
+    for bar, label in zip(bars, labels):
+        width = bar.get_width()
+        label.set_text("{0:.0f}".format(width))
+        label.xy = (bar.get_x() + width/2, bar.get_y())
+        label.set_visible(width > 0)
+
+def _label_bars(ax, bars, text_offset, text_size):
+    """Adds a percentage label to every bar and returns the labels"""
+    labels = [ax.annotate('', (0, 0), xytext=(0, text_offset), textcoords='offset points',
+                          weight='bold', size=text_size, ha='center') for bar in bars]
+    _update_bar_labels(bars, labels)
+    return labels
+
+def _draw_summary_bars(table2, colours, figsize, linewidth, text_offset, text_size):
+    """Draws the stacked percentage bar of a summary table, returns the figure, axes and bar labels"""
+    fig, ax = plt.subplots(figsize=figsize)
     table2.loc[('', 'percent'), :].plot(kind='barh', stacked=True, color=colours, legend=False, width=0.6,
                                               ax=ax)
     sns.despine(top=True, right=True, left=True, bottom=True)
@@ -65,205 +232,531 @@ def draw_basic_plot(table, likert=True):
 
     #create the white spaces between the squares
     rects = ax.patches
-    [rect.set(edgecolor='white', linewidth=3) for rect in rects]
+    [rect.set(edgecolor='white', linewidth=linewidth) for rect in rects]
 
     # Adding the percentage labels
-    for p in ax.patches:
-        if p.get_width() > 0:
-            ax.annotate("{0:.0f}".format(p.get_width()),
-                    (p.get_x() + p.get_width()/2, p.get_y()), xytext=(0, 29), textcoords='offset points',
-                    weight='bold', size=15, ha='center')
-    question_name = table2.columns.name
-    fig.subplots_adjust(top = 0.99, bottom = 0.01, right = 0.99, left = 0.01,
-            hspace = 0, wspace = 0)
-    plt.savefig('output/'+question_name+'.pdf', dpi=600, transparent=True)
-    plt.savefig('output/'+question_name+'.jpg', dpi=600, transparent=True)
-    plt.close()
+    labels = _label_bars(ax, list(ax.patches), text_offset, text_size)
+    return fig, ax, labels
 
-def draw_basic_plot(table, likert=True, folder_path='../../output/'):
-    """Generates and saves standard GT bar plots from summary tables of likert questions and binary questions."""
-    sns.set(style='white')
-    table2 = table.set_index(table.columns[0])
-    table2 = table2.transpose()
-    table2.loc['', :] = np.zeros(len(table2.columns))
+def _update_summary_bars(ax, labels, table2, colours):
+    """Redraws a figure from _draw_summary_bars in place for another summary table with as many responses"""
+    _update_stacked_bars(ax.patches, table2.loc[('', 'percent'), :].fillna(0).values, colours)
+    ax.set_xlim(0, table2.loc['percent', :].sum())
+    _update_bar_labels(ax.patches, labels)
 
-    if likert == True:
-        likert_dict ={1: "#f19891", 2: "#f8cac3", 3:"#e9ecf0", 4:"#b2cfb3", 5:"#4aa168", 6:"#c9d5dd", 7:'#9bb2bf'}
-        likert_keys = [np.int(label.split('_')[0]) for label in table2.columns]
-        likert_colours = sns.color_palette([likert_dict[x] for x in likert_keys])
-        colours = likert_colours
-    else:
-        binary_dict = {1: "#f19891", 2: "#4aa168", 3: "#c9d5dd", 4: '#9bb2bf'}
-        binary_keys = [np.int(label.split('_')[0]) for label in table2.columns]
-        binary_colours = sns.color_palette([binary_dict[x] for x in binary_keys])
-        colours = binary_colours
+def _disag_plot_table(table, reindex_order=np.nan):
+    """Turns a disaggregated table into the table the disaggregated bar plots are drawn from"""
+    table2 = table.pivot(index=table.columns[0], columns=table.columns[1], values='percent')
+    if reindex_order == reindex_order:
+        table2 = table2.reindex(reindex_order)
+    index = list(table2.index)
+    index.reverse()
+    return table2.reindex(index)
 
-    fig, ax = plt.subplots(figsize=(7.5, 1))
-    table2.loc[('', 'percent'), :].plot(kind='barh', stacked=True, color=colours, legend=False, width=0.6,
-                                              ax=ax)
+def _draw_disag_bars(table2, colours, fig_height):
+    """Draws the stacked percentage bars of a disaggregated table, returns the figure, axes and bar labels"""
+    fig, ax = plt.subplots(figsize=(7.5, fig_height))
+    table2.plot(kind='barh', stacked=True, color=colours, ax=ax, legend=False, width=0.6)
+
+    # remove black lines around the figure
     sns.despine(top=True, right=True, left=True, bottom=True)
-    ax.set(xlim=(0, table2.loc['percent', :].sum()), ylim=(0.7, 1.3), yticklabels=(), xticklabels=[])
+    ax.set(xlim=(0, 100), ylabel='', yticklabels=[], xticklabels=[])
 
     #create the white spaces between the squares
     rects = ax.patches
     [rect.set(edgecolor='white', linewidth=3) for rect in rects]
 
     # Adding the percentage labels
-    for p in ax.patches:
-        if p.get_width() > 0:
-            ax.annotate("{0:.0f}".format(p.get_width()),
-                    (p.get_x() + p.get_width()/2, p.get_y()), xytext=(0, 29), textcoords='offset points',
-                    weight='bold', size=15, ha='center')
+    labels = _label_bars(ax, list(ax.patches), 15, 15)
+    fig.subplots_adjust(top = 1, bottom = 0, right = 1, left = 0,
+    hspace = 0, wspace = 0)
+    return fig, ax, labels
+
+def _disag_plot_path(table2, folder_path):
+    """The file stem a disaggregated plot is saved to"""
+    question_name = table2.columns.name.split('_')[0] + '_by_' + table2.index.name.split('_')[0] + '_order'
+    for alternative in reversed(table2.index):
+        question_name = question_name + '_' + np.str(alternative).split('_')[0]
+    return folder_path + table2.index.name + '_breakdowns/' + question_name
+
+def draw_basic_plot(table, likert=True, export_profile=DEFAULT_EXPORT_PROFILE):
+    """Generates and saves standard GT bar plots from summary tables of likert questions and binary questions."""
+    use_style(style='white')
+    table2 = _summary_plot_table(table)
+    colours = response_palette(table2.columns, likert)
+
+    fig, ax, labels = _draw_summary_bars(table2, colours, (7.5, 1), 3, 29, 15)
+    question_name = table2.columns.name
+    fig.subplots_adjust(top = 0.99, bottom = 0.01, right = 0.99, left = 0.01,
+            hspace = 0, wspace = 0)
+    export_figure(fig, 'output/'+question_name, ('pdf', 'jpg'), export_profile)
+    plt.close()
+
+def draw_basic_plot(table, likert=True, folder_path='../../output/', export_profile=DEFAULT_EXPORT_PROFILE):
+    """Generates and saves standard GT bar plots from summary tables of likert questions and binary questions."""
+    use_style(style='white')
+    table2 = _summary_plot_table(table)
+    colours = response_palette(table2.columns, likert)
+
+    fig, ax, labels = _draw_summary_bars(table2, colours, (7.5, 1), 3, 29, 15)
     question_name = table2.columns.name
     fig.subplots_adjust(top = 0.99, bottom = 0.01, right = 0.99, left = 0.01,
             hspace = 0, wspace = 0)
-    plt.savefig(folder_path+question_name+'.pdf', dpi=600, transparent=True)
-    plt.savefig(folder_path+question_name+'.jpg', dpi=600, transparent=True)
+    export_figure(fig, folder_path+question_name, ('pdf', 'jpg'), export_profile)
     plt.close()
 
 def gen_disag_table(data, question, breakdown):
     """Generates summary tables for disaggregated data"""
-    table = data.groupby(breakdown)[question].value_counts(sort=False)
-    table = pd.DataFrame(table)
-    table.columns = ['frequency']
-    table = table.reset_index()
-    table = table.sort_values(by=[breakdown, question])
-    table.reset_index(inplace=True, drop=True)
-    table
-    table['percent'] = table['frequency']
-    table['cum_frequency'] = table['frequency']
-    table['cum_proportion'] = np.nan
-
-    for category in table[breakdown].unique():
-        counter = 0
-        for index in table.loc[table[breakdown]==category].index:
-            if counter > 0:
-                table.loc[index, 'cum_frequency'] = table.loc[index, 'frequency'] + table.loc[index-1, 'cum_frequency']
-            counter +=1
-        table.loc[table[breakdown]==category, 'percent'] = (table.loc[table[breakdown]==category, 'percent']/
-        table.loc[table.loc[table[breakdown]==category, :].index.max(), 'cum_frequency'])
-        table.loc[table[breakdown]==category, 'percent'] = table.loc[table[breakdown]==category, 'percent']*100
-        table.loc[table[breakdown]==category, 'cum_proportion'] = (table.loc[table[breakdown]==category, 'cum_frequency']/
-        table.loc[table.loc[table[breakdown]==category, :].index.max(), 'cum_frequency'])
-    return table
-
-def draw_disag_plot(table, likert=True, reindex_order=np.nan, folder_path='../../output/'):
+    codes, categories = _response_codes(data[question])
+    group_codes, groups = _response_codes(data[breakdown])
+    counts = _count_responses(codes, len(categories), group_codes, len(groups))
+    return _disag_table_from_counts(breakdown, groups, question, categories, counts)
+
+def summary_table_questions(data, template):
+    """Lists the columns that get summary tables: likert and binary questions, and the binned version
+    (see data_cleaning.bin_quantities) of quantity questions. The template can be a Template or a
+    template data frame in either orientation."""
+    questions = []
+    for question in Template.compile(template):
+        if question.question_type in ['likert', 'binary'] and question.name in data.columns:
+            questions.append(question.name)
+        elif question.question_type == 'quantity' and question.name + '_quantiles' in data.columns:
+            questions.append(question.name + '_quantiles')
+    return questions
+
+def _response_codes(series):
+    """Factorizes a column into integer codes (-1 for missing values) and its sorted categories"""
+    if series.dtype.name == 'category':
+        return np.asarray(series.cat.codes), np.asarray(series.cat.categories)
+    codes, categories = pd.factorize(series, sort=True)
+    return codes, np.asarray(categories)
+
+def _count_responses(codes, n_categories, group_codes=None, n_groups=1):
+    """Counts integer coded responses with np.bincount, returns a groups x categories matrix"""
+    valid = codes >= 0
+    if group_codes is None:
+        keys = codes[valid]
+    else:
+        valid &= group_codes >= 0
+        keys = group_codes[valid]*n_categories + codes[valid]
+    counts = np.bincount(keys, minlength=n_groups*n_categories)
+    return counts.reshape(n_groups, n_categories)
+
+def _summary_table_from_counts(question, categories, counts):
+    """Builds a summary table from a vector of response counts, leaving out responses nobody gave"""
+    observed = np.nonzero(counts)[0]
+    table = pd.DataFrame({question: categories[observed], 'frequency': counts[observed]},
+                         columns=[question, 'frequency'])
+    return add_cumulative_frequencies(table, round_percent=True)
+
+def _disag_table_from_counts(breakdown, groups, question, categories, counts):
+    """Builds a disaggregated table from a breakdown x response matrix of counts, leaving out empty cells"""
+    group_index, response_index = np.nonzero(counts)
+    table = pd.DataFrame({breakdown: groups[group_index], question: categories[response_index],
+                          'frequency': counts[group_index, response_index]},
+                         columns=[breakdown, question, 'frequency'])
+    return add_cumulative_frequencies(table, group_columns=[breakdown])
+
+def gen_summary_table_from_counts(counts, question):
+    """Generates the same summary table as gen_summary_table from a series of response counts, e.g. the
+    counts accumulated by data_cleaning.CleaningPipeline"""
+    counts = counts.sort_index()
+    return _summary_table_from_counts(question, np.asarray(counts.index), counts.values.astype(int))
+
+def gen_summary_tables(data, template, breakdowns=None):
+    """Generates summary tables for all likert, binary and quantity questions in a template in one pass.
+
+    Every question and breakdown column is factorized into integer codes once (categorical columns
+    already are), and the frequencies are counted with np.bincount instead of one value_counts per
+    question. Returns two dictionaries: summary tables keyed by question (same format as
+    gen_summary_table) and disaggregated tables keyed by (breakdown, question) (same format as
+    gen_disag_table). The second dictionary is empty if no breakdowns are given."""
+    if breakdowns is None:
+        breakdowns = []
+    elif isinstance(breakdowns, basestring):
+        breakdowns = [breakdowns]
+
+    breakdown_codes = {}
+    for breakdown in breakdowns:
+        breakdown_codes[breakdown] = _response_codes(data[breakdown])
+
+    summary_tables = {}
+    disag_tables = {}
+    for question in summary_table_questions(data, template):
+        codes, categories = _response_codes(data[question])
+        n_categories = len(categories)
+        counts = _count_responses(codes, n_categories)[0]
+        summary_tables[question] = _summary_table_from_counts(question, categories, counts)
+
+        for breakdown in breakdowns:
+            if breakdown == question:
+                continue
+            group_codes, groups = breakdown_codes[breakdown]
+            counts = _count_responses(codes, n_categories, group_codes, len(groups))
+            disag_tables[(breakdown, question)] = _disag_table_from_counts(breakdown, groups, question,
+                                                                           categories, counts)
+
+    return summary_tables, disag_tables
+
+class FrequencyAccumulator(object):
+    """Accumulates response counts so that summary tables can be refreshed batch by batch.
+
+    update() adds the counts of a new batch of data, merge() adds the counts of another accumulator
+    (e.g. one per enumerator or region file), and save()/load() keep the counts on disk between
+    refreshes. summary_table, disag_table and long_table give the same tables as gen_summary_table,
+    gen_disag_table and gen_long_table would give for all the data seen so far, so a refresh only
+    costs as much as counting the new batch."""
+
+    def __init__(self, questions, breakdowns=None):
+        self.questions = list(questions)
+        self.breakdowns = list(breakdowns) if breakdowns is not None else []
+        self.counts = {}
+        self.disag_counts = {}
+
+    @staticmethod
+    def _add(store, key, counts):
+        counts = counts[counts > 0]
+        if key in store:
+            counts = store[key].add(counts, fill_value=0).astype(int)
+        store[key] = counts
+
+    def update(self, data):
+        """Adds the response counts of a batch of data"""
+        breakdown_codes = dict([(breakdown, _response_codes(data[breakdown])) for breakdown in self.breakdowns])
+        for question in self.questions:
+            codes, categories = _response_codes(data[question])
+            counts = _count_responses(codes, len(categories))[0]
+            self._add(self.counts, question, pd.Series(counts, index=categories))
+            for breakdown in self.breakdowns:
+                if breakdown == question:
+                    continue
+                group_codes, groups = breakdown_codes[breakdown]
+                counts = _count_responses(codes, len(categories), group_codes, len(groups))
+                group_index, response_index = np.nonzero(counts)
+                index = pd.MultiIndex.from_arrays([groups[group_index], categories[response_index]])
+                self._add(self.disag_counts, (breakdown, question),
+                          pd.Series(counts[group_index, response_index], index=index))
+        return self
+
+    def merge(self, other):
+        """Adds the counts of another accumulator to this one"""
+        for question, counts in other.counts.items():
+            self._add(self.counts, question, counts)
+        for key, counts in other.disag_counts.items():
+            self._add(self.disag_counts, key, counts)
+        self.questions += [question for question in other.questions if question not in self.questions]
+        self.breakdowns += [breakdown for breakdown in other.breakdowns if breakdown not in self.breakdowns]
+        return self
+
+    def save(self, path):
+        """Saves the accumulated counts to a pickle file"""
+        pd.to_pickle({'questions': self.questions, 'breakdowns': self.breakdowns,
+                      'counts': self.counts, 'disag_counts': self.disag_counts}, path)
+
+    @classmethod
+    def load(cls, path):
+        """Loads an accumulator saved with save()"""
+        state = pd.read_pickle(path)
+        accumulator = cls(state['questions'], state['breakdowns'])
+        accumulator.counts = state['counts']
+        accumulator.disag_counts = state['disag_counts']
+        return accumulator
+
+    def summary_table(self, question):
+        """Same table as gen_summary_table, from the accumulated counts"""
+        return gen_summary_table_from_counts(self.counts[question], question)
+
+    def disag_table(self, question, breakdown):
+        """Same table as gen_disag_table, from the accumulated counts"""
+        counts = self.disag_counts[(breakdown, question)].sort_index()
+        table = pd.DataFrame({breakdown: counts.index.get_level_values(0),
+                              question: counts.index.get_level_values(1),
+                              'frequency': counts.values.astype(int)},
+                             columns=[breakdown, question, 'frequency'])
+        return add_cumulative_frequencies(table, group_columns=[breakdown])
+
+    def long_table(self, questions):
+        """Same frequency table as gen_long_table writes, combining the counts of several questions"""
+        counts = pd.concat([self.counts[question] for question in questions])
+        counts = counts.groupby(level=0).sum().sort_values(ascending=False)
+        freq_count = pd.DataFrame({'frequency': counts, 'percent': counts/np.float(counts.sum())*100},
+                                  columns=['frequency', 'percent'])
+        freq_count.index = normalize_text(pd.Series(freq_count.index), lower=False, collapse_whitespace=False).values
+        return freq_count
+
+def draw_disag_plot(table, likert=True, reindex_order=np.nan, folder_path='../../output/',
+                    export_profile=DEFAULT_EXPORT_PROFILE):
     """Generates and saves standard GT bar plots from disaggregated tables"""
 
     # this formula ensures that the figure gets 2 inches wider for each category, with an additional inch for
     # the whitespaces between categories
-    sns.set(style='white')
+    use_style(style='white')
     fig_height = len(table.loc[:, table.columns[0]].unique())
-    fig, ax = plt.subplots(figsize=(7.5, fig_height))
 
     # preparing and plotting the basic graph
-    table2 = table.pivot(index=table.columns[0], columns=table.columns[1], values='percent')
-    if reindex_order == reindex_order:
-        table2 = table2.reindex(reindex_order)
-    index = list(table2.index)
-    if likert == True:
-        likert_dict ={1: "#f19891", 2: "#f8cac3", 3:"#e9ecf0", 4:"#b2cfb3", 5:"#4aa168", 6:"#c9d5dd", 7:'#9bb2bf'}
-        likert_keys = [np.int(label.split('_')[0]) for label in table2.columns]
-        likert_colours = sns.color_palette([likert_dict[x] for x in likert_keys])
-        colours = likert_colours
-    else:
-        binary_dict = {1: "#f19891", 2: "#4aa168", 3: "#c9d5dd", 4: '#9bb2bf'}
-        binary_keys = [np.int(label.split('_')[0]) for label in table2.columns]
-        binary_colours = sns.color_palette([binary_dict[x] for x in binary_keys])
-        colours = binary_colours
-
-    index.reverse()
-    table2 = table2.reindex(index)
-    table2.plot(kind='barh', stacked=True, color=colours, ax=ax, legend=False, width=0.6)
+    table2 = _disag_plot_table(table, reindex_order)
+    colours = response_palette(table2.columns, likert)
+    fig, ax, labels = _draw_disag_bars(table2, colours, fig_height)
 
-    # remove black lines around the figure
-    sns.despine(top=True, right=True, left=True, bottom=True)
-    alternatives = ax.get_yticklabels()
-    alternatives = [alternative.get_text() for alternative in list(alternatives)]
-    alternatives.reverse()
-    ax.set(xlim=(0, 100), ylabel='', yticklabels=[], xticklabels=[])
-
-    #create the white spaces between the squares
-    rects = ax.patches
-    [rect.set(edgecolor='white', linewidth=3) for rect in rects]
-
-    # Adding the percentage labels
-    for p in ax.patches:
-        if p.get_width() > 0:
-            ax.annotate("{0:.0f}".format(p.get_width()),
-                    (p.get_x() + p.get_width()/2, p.get_y()), xytext=(0, 15), textcoords='offset points',
-                   weight='bold', size=15, ha='center')
     # savefig
-    question_name = table2.columns.name.split('_')[0] + '_by_' + table2.index.name.split('_')[0] + '_order'
-    for alternative in alternatives:
-        question_name = question_name + '_' + np.str(alternative).split('_')[0]
-
-    fig.subplots_adjust(top = 1, bottom = 0, right = 1, left = 0,
-    hspace = 0, wspace = 0)
-    plt.savefig(folder_path + table2.index.name + '_breakdowns/' + question_name+'.pdf', dpi=600, transparent=True)
-    plt.savefig(folder_path + table2.index.name + '_breakdowns/' + question_name+'.jpg', dpi=600, transparent=True)
+    export_figure(fig, _disag_plot_path(table2, folder_path), ('pdf', 'jpg'), export_profile)
     plt.close()
 
-def gen_long_table(data, question_lists_1, filename):
-    long_list_1 = data.loc[:, question_lists_1].copy()
-    long_list_1 = pd.melt(long_list_1, value_vars=list(question_lists_1))
-    freq_count = pd.DataFrame(long_list_1['value'].value_counts())
-    percent_count = pd.DataFrame(long_list_1['value'].value_counts(normalize=True))
-    freq_count['percent'] = percent_count['value']
-    freq_count['percent'] = freq_count['percent']*100
-    clean_index=[]
-    for text in freq_count.index:
-        clean_index.append(remove_non_ascii(text))
-    freq_count.index = clean_index
-    freq_count.columns = ['frequency', 'percent']
-    freq_count.to_csv(filename)
-
-def draw_time_series_plot(data, question, session, mean, filename):
+def _plot_folder(function_name, table, kwargs):
+    """Returns the folder a draw function saves its figure to, using the same layout as the draw functions"""
+    folder_path = kwargs.get('folder_path', '../../output/')
+    if function_name == 'draw_disag_plot':
+        folder_path = folder_path + table.columns[0] + '_breakdowns/'
+    return folder_path
+
+def _plot_job_name(function_name, table):
+    """Describes which question a plot job draws, for the render report"""
+    if function_name == 'draw_disag_plot':
+        return table.columns[1] + ' by ' + table.columns[0]
+    return table.columns[0]
+
+def _init_render_worker():
+    """Switches worker processes to the non-interactive Agg backend"""
+    plt.switch_backend('Agg')
+
+def _render_plot_job(job):
+    """Renders one plot job in a worker process and records how long it took and whether it failed. A job
+    that can't be described (e.g. one without a table) is reported as a failure under repr(job[:1])."""
+    start = time.time()
+    name = repr(job[:1])
+    error = None
+    try:
+        function_name, table = job[0], job[1]
+        kwargs = job[2] if len(job) > 2 else {}
+        name = _plot_job_name(function_name, table)
+        globals()[function_name](table, **kwargs)
+    except Exception:
+        error = traceback.format_exc()
+        plt.close('all')
+    return {'function': job[0] if len(job) > 0 else None, 'question': name,
+            'seconds': time.time() - start, 'error': error}
+
+def render_plots(jobs, processes=None):
+    """Renders a list of plot jobs in a process pool using the Agg backend.
+
+    Each job is a tuple of the name of a draw function (e.g. 'draw_basic_plot' or 'draw_disag_plot'), the
+    table to plot and optionally a dictionary of keyword arguments for the draw function. Output folders,
+    including the <breakdown>_breakdowns/ folders used by draw_disag_plot, are created before rendering.
+    Returns a data frame with the rendering time and the traceback of any failure for every figure."""
+    for job in jobs:
+        try:
+            kwargs = job[2] if len(job) > 2 else {}
+            folder_path = _plot_folder(job[0], job[1], kwargs)
+        except Exception:
+            # a job that is not well formed fails in _render_plot_job, where the failure is reported
+            continue
+        if folder_path and not os.path.exists(folder_path):
+            os.makedirs(folder_path)
+
+    start = time.time()
+    pool = multiprocessing.Pool(processes, initializer=_init_render_worker)
+    try:
+        results = pool.map(_render_plot_job, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    report = pd.DataFrame(results, columns=['function', 'question', 'seconds', 'error'])
+    failures = report.loc[report['error'].notnull(), 'question']
+    print '%d plots rendered in %.1f seconds, %d failed' %(len(report), time.time() - start, len(failures))
+    if len(failures) > 0:
+        print list(failures)
+    return report
+
+def open_response_questions(template, question_types=('open', 'open_list')):
+    """Lists the open and open list columns of a template"""
+    return [question.name for question in Template.compile(template).of_type(*question_types)]
+
+def _merge_top_counts(counts, new_counts, capacity=None):
+    """Adds new counts to the running counts. With a capacity, only the capacity largest counts are kept
+    and the largest dropped count is subtracted from them (weighted Misra-Gries)"""
+    counts = counts.add(new_counts, fill_value=0)
+    if capacity is not None and len(counts) > capacity:
+        counts = counts.sort_values(ascending=False)
+        counts = counts.iloc[:capacity] - counts.iloc[capacity]
+        counts = counts[counts > 0]
+    return counts
+
+def count_open_responses(data, columns, top_k=None, capacity=None):
+    """Counts the answers of several open response columns (e.g. the Qn-1_..., Qn-2_... columns of an
+    open list question) together, one column at a time, without melting them into one long frame.
+    Returns a frequency table indexed by answer with frequency and percent (of all non-missing answers).
+
+    Without top_k the counts are exact. With top_k only the top_k most frequent answers are returned and
+    at most capacity (default 10*top_k) distinct answers are kept between columns. Every answer given in
+    more than 1/capacity of all responses is kept, but the frequencies of the returned answers can then be
+    underestimated by up to that share of the responses."""
+    if top_k is not None and capacity is None:
+        capacity = 10*top_k
+    counts = pd.Series([], dtype=float)
+    total = 0
+    for column in columns:
+        column_counts = data[column].value_counts()
+        column_counts = column_counts[column_counts > 0]
+        total += column_counts.sum()
+        counts = _merge_top_counts(counts, column_counts, capacity)
+    counts = counts.sort_values(ascending=False)
+    if top_k is not None:
+        counts = counts.iloc[:top_k]
+    return pd.DataFrame({'frequency': counts.astype(int), 'percent': counts/np.float(total)*100},
+                        columns=['frequency', 'percent'])
+
+def write_frequency_table(freq_count, file_path, sheet_name='frequencies'):
+    """Writes a frequency table to an Excel file (.xls/.xlsx) or else to a csv file"""
+    if os.path.splitext(file_path)[1].lower() in ['.xls', '.xlsx']:
+        freq_count.to_excel(file_path, sheet_name)
+    else:
+        freq_count.to_csv(file_path)
+
+def gen_long_table(data, question_lists_1, filename, top_k=None):
+    """Writes one frequency table for the answers to several open response columns, see
+    count_open_responses"""
+    freq_count = count_open_responses(data, question_lists_1, top_k)
+    freq_count.index = normalize_text(pd.Series(freq_count.index), lower=False, collapse_whitespace=False).values
+    write_frequency_table(freq_count, filename)
+
+def draw_time_series_plot(data, question, session, mean, filename, export_profile=DEFAULT_EXPORT_PROFILE):
     """Draw plot to track mean changes across rounds"""
     question_data = data.loc[(data['Question']==question), :].copy()
+    if 'Position' in question_data.columns:
+        question_data = question_data.sort_values('Position', kind='mergesort')
+    _draw_time_series(question_data, session, mean, filename, export_profile)
 
-    sns.set(font_scale=0.8, style='whitegrid')
+def _draw_time_series(question_data, session, mean, filename, export_profile=DEFAULT_EXPORT_PROFILE):
+    """Draws the mean of one question per round, from the rows of that question only"""
+    use_style(style='whitegrid', font_scale=0.8)
     fig, ax = plt.subplots(figsize=(3.22, 1.23))
 
-    sns.pointplot(data=question_data,
-                 x=session, y=mean, markers='D', color='#65889d', scale=0.5)
+    sns.pointplot(data=question_data, x=session, y=mean, order=pd.unique(question_data[session]),
+                 markers='D', color='#65889d', scale=0.5)
     ax.set(ylabel='', ylim=(1, 5), xlabel='',
             xticklabels= '',#['Round %d' %round for round in example.loc[:, 'Round']],
             yticklabels=('1','', '2', '', '3', '', '4', '', '5'))
 
     [ax.text(p[0], p[1]+0.3, p[1], color='black', ha='center', size=9) for p in zip(ax.get_xticks(),
-            question_data.loc[:, 'Mean'].round(1))]
+            question_data.loc[:, mean].round(1))]
 
     fig.subplots_adjust(top = 0.96, bottom = 0.04, right = 0.99, left = 0.06,
             hspace = 0, wspace = 0)
-    plt.savefig(filename + '.pdf', dpi=600, transparent=True)
-    plt.savefig(filename + '.png', dpi=600, transparent=True)
+    export_figure(fig, filename, ('pdf', 'png'), export_profile)
     plt.close()
 
-def draw_basic_exp_plot(table, likert=True):
+def _natural_sort_key(name):
+    """Sort key that compares the numbers in a name as numbers, so 'R2' comes before 'R10'"""
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', str(name))]
+
+def round_statistics(rounds, template, session='Round', questions=None):
+    """Computes the mean, standard error and count of every question in every survey round.
+
+    rounds is a list of (round, cleaned data) pairs that share the template, or a dict of them. Rounds keep
+    the order they are given in (an OrderedDict keeps its order, the rounds of a plain dict are sorted by
+    name with the numbers in the names compared as numbers, so R2 comes before R10). By default all likert
+    questions of the template are included. Text responses are scored by the number they start with
+    (see data_cleaning.response_numbers), don't knows are left out. The statistics of all questions and
+    rounds come from one groupby, returned as a tidy table with the columns Question, session, Position
+    (the place of the round in the order), Mean, SE and Count, as draw_time_series_plot expects."""
+    template = Template.compile(template)
+    if questions is None:
+        questions = [question.name for question in template.of_type('likert')]
+    if isinstance(rounds, collections.OrderedDict):
+        rounds = rounds.items()
+    elif hasattr(rounds, 'items'):
+        rounds = [(round_name, rounds[round_name]) for round_name in sorted(rounds, key=_natural_sort_key)]
+
+    numeric_rounds = []
+    for position, (round_name, data) in enumerate(rounds):
+        numeric = pd.DataFrame(index=data.index)
+        for question in questions:
+            if question not in data.columns:
+                numeric[question] = np.nan
+            elif data[question].dtype.kind in 'biuf':
+                numeric[question] = data[question]
+            else:
+                # as categoricals only the distinct responses are parsed
+                responses = data[question].astype('category')
+                responses = responses.cat.remove_categories([response for response in DONT_KNOW_RESPONSES
+                                                             if response in responses.cat.categories])
+                numeric[question] = response_numbers(responses)
+        numeric[session] = round_name
+        numeric['Position'] = position
+        numeric_rounds.append(numeric)
+    numeric = pd.concat(numeric_rounds, ignore_index=True)
+
+    # grouping on the position first orders the rounds as given rather than by name
+    stats = numeric.groupby(['Position', session])[questions].agg(['mean', 'sem', 'count'])
+    stats = stats.stack(level=0)
+    stats.index.names = ['Position', session, 'Question']
+    stats = stats.reset_index()
+    stats = stats.rename(columns={'mean': 'Mean', 'sem': 'SE', 'count': 'Count'})
+    return stats[['Question', session, 'Position', 'Mean', 'SE', 'Count']]
+
+def append_round_statistics(store_path, stats, session='Round', key='round_statistics'):
+    """Appends round statistics (see round_statistics) to an HDF5 store, indexed by question and round.
+    Rows of rounds that are already in the store are replaced, so a round can be recomputed, and keep their
+    Position. New rounds are placed after the rounds in the store, in the order of their Position in stats."""
+    # text columns get a fixed width when the table is created, leave room for longer later names
+    min_itemsize = {'Question': 100}
+    if stats[session].dtype == object:
+        min_itemsize[session] = 50
+    store = pd.HDFStore(store_path, mode='a')
+    try:
+        if key in store:
+            stored = store.select(key, columns=[session, 'Position'])
+            positions = dict(zip(stored[session], stored['Position']))
+            next_position = stored['Position'].max() + 1 if len(stored) else 0
+            rounds = stats.drop_duplicates(session).sort_values('Position')[session].tolist()
+            for round_name in rounds:
+                if round_name not in positions:
+                    positions[round_name] = next_position
+                    next_position += 1
+            stats = stats.copy()
+            stats['Position'] = stats[session].map(positions).astype(stats['Position'].dtype)
+            store.remove(key, where='%s == rounds' %session)
+        store.append(key, stats, format='table', data_columns=['Question', session],
+                     min_itemsize=min_itemsize, index=False)
+        store.create_table_index(key, columns=['Question', session], optlevel=9, kind='full')
+    finally:
+        store.close()
+
+def load_round_statistics(store_path, questions=None, key='round_statistics'):
+    """Loads round statistics from an HDF5 store, only those of the given questions if there are any"""
+    if questions is None:
+        return pd.read_hdf(store_path, key)
+    questions = list(questions)
+    return pd.read_hdf(store_path, key, where='Question == questions')
+
+def draw_time_series_plots(stats, session='Round', folder_path='../../output/', export_profile=DEFAULT_EXPORT_PROFILE):
+    """Draws the trend plot of every question in a table of round statistics (see round_statistics or
+    load_round_statistics), splitting the table by question once instead of filtering it for every
+    plot. The rounds are plotted in the order of their Position. Plots are saved as
+    <folder_path><question>_rounds."""
+    for question, question_data in stats.groupby('Question', sort=False):
+        question_data = question_data.sort_values('Position', kind='mergesort')
+        _draw_time_series(question_data, session, 'Mean', folder_path + question + '_rounds', export_profile)
+
+def draw_basic_exp_plot(table, likert=True, ax=None):
     """Generates and saves standard GT bar plots from summary tables of likert questions and binary questions.
-    Gives a title to make the questions easy to identify, not meant for report writing."""
-    sns.set(style='white')
+    Gives a title to make the questions easy to identify, not meant for report writing. Draws into ax if one
+    is given (e.g. a panel of write_exploratory_pdf), otherwise into a new figure."""
+    use_style(style='white')
     table2 = table.set_index(table.columns[0])
     table2 = table2.transpose()
     table2.loc[' ', :] = np.zeros(len(table2.columns))
     question_name = ' '.join(table2.columns.name.split('_'))
 
-    if likert == True:
-        likert_dict ={1: "#f19891", 2: "#f8cac3", 3:"#e9ecf0", 4:"#b2cfb3", 5:"#4aa168", 6:"#c9d5dd", 7:'#9bb2bf'}
-        likert_keys = [np.int(label.split('_')[0]) for label in table2.columns]
-        likert_colours = sns.color_palette([likert_dict[x] for x in likert_keys])
-        colours = likert_colours
-    else:
-        binary_dict = {1: "#f19891", 2: "#4aa168", 3: "#c9d5dd", 4: '#9bb2bf'}
-        binary_keys = [np.int(label.split('_')[0]) for label in table2.columns]
-        binary_colours = sns.color_palette([binary_dict[x] for x in binary_keys])
-        colours = binary_colours
+    colours = response_palette(table2.columns, likert)
 
-    fig, ax = plt.subplots(figsize=(7.5, 1))
+    new_figure = ax is None
+    if new_figure:
+        fig, ax = plt.subplots(figsize=(7.5, 1))
     table2.loc[('', 'percent'), :].plot(kind='barh', stacked=True, color=colours, legend=False, width=0.6,
                                               ax=ax, title=question_name)
-    sns.despine(top=True, right=True, left=True, bottom=True)
+    sns.despine(ax=ax, top=True, right=True, left=True, bottom=True)
     ax.set(xlim=(0, table2.loc['percent', :].sum()), ylim=(0.7, 1.3), yticklabels=(), xticklabels=[])
 
     #create the white spaces between the squares
@@ -276,32 +769,27 @@ def draw_basic_exp_plot(table, likert=True):
             ax.annotate("{0:.0f}".format(p.get_width()),
                     (p.get_x() + p.get_width()/2, p.get_y()), xytext=(0, 11), textcoords='offset points',
                     weight='bold', size=15, ha='center')
-    plt.tight_layout()
+    if new_figure:
+        plt.tight_layout()
 
-def draw_disag_exp_plot(table, likert=True, reindex_order=np.nan):
+def draw_disag_exp_plot(table, likert=True, reindex_order=np.nan, ax=None):
     """Generates and saves standard GT bar plots from disaggregated tables. Contains Question titles and
-    category labels. For exploratory use, not report writing."""
+    category labels. For exploratory use, not report writing. Draws into ax if one is given, otherwise into
+    a new figure."""
 
     # this formula ensures that the figure gets 2 inches wider for each category, with an additional inch for
     # the whitespaces between categories
     fig_height = len(table.loc[:, table.columns[0]].unique())
-    fig, ax = plt.subplots(figsize=(7.5, fig_height))
+    new_figure = ax is None
+    if new_figure:
+        fig, ax = plt.subplots(figsize=(7.5, fig_height))
 
     # preparing and plotting the basic graph
     table2 = table.pivot(index=table.columns[0], columns=table.columns[1], values='percent')
     if reindex_order == reindex_order:
         table2 = table2.reindex(reindex_order)
     index = list(table2.index)
-    if likert == True:
-        likert_dict ={1: "#f19891", 2: "#f8cac3", 3:"#e9ecf0", 4:"#b2cfb3", 5:"#4aa168", 6:"#c9d5dd", 7:'#9bb2bf'}
-        likert_keys = [np.int(label.split('_')[0]) for label in table2.columns]
-        likert_colours = sns.color_palette([likert_dict[x] for x in likert_keys])
-        colours = likert_colours
-    else:
-        binary_dict = {1: "#f19891", 2: "#4aa168", 3: "#c9d5dd", 4: '#9bb2bf'}
-        binary_keys = [np.int(label.split('_')[0]) for label in table2.columns]
-        binary_colours = sns.color_palette([binary_dict[x] for x in binary_keys])
-        colours = binary_colours
+    colours = response_palette(table2.columns, likert)
 
     index.reverse()
     table2 = table2.reindex(index)
@@ -310,7 +798,7 @@ def draw_disag_exp_plot(table, likert=True, reindex_order=np.nan):
                title=question_name)
 
     # remove black lines around the figure
-    sns.despine(top=True, right=True, left=True, bottom=True)
+    sns.despine(ax=ax, top=True, right=True, left=True, bottom=True)
     alternatives = ax.get_yticklabels()
     alternatives = [alternative.get_text() for alternative in list(alternatives)]
     alternatives.reverse()
@@ -326,35 +814,170 @@ def draw_disag_exp_plot(table, likert=True, reindex_order=np.nan):
             ax.annotate("{0:.0f}".format(p.get_width()),
                     (p.get_x() + p.get_width()/2, p.get_y()), xytext=(0, 15), textcoords='offset points',
                    weight='bold', size=15, ha='center')
-    plt.tight_layout()
-
-def write_large_freq_table(data, column_list, name):
-    "Combines data from several columns of open responses into one large frequency table"
-    long_list = pd.melt(data, value_vars=column_list)
-    frequency_table = pd.DataFrame(long_list['value'].value_counts())
-    frequency_table.to_excel(writer, name, startrow=0)
-
-def gen_multiple_choice_tables(option_list, question):
-    """This is a function that generates frequency and output tables for multiple choice questions.
-    It takes two inputs: A list of column names for the various options, and the column name of the
-    question the tables should be generated for."""
-    table_list = []
-
-    for option in option_list:
-        table = data.groupby(option)[question].value_counts(sort=False)
-        table = pd.DataFrame(table)
-        table.columns = ['frequency']
-        table = table.reset_index()
-        table = table.loc[table[table.columns[0]]==True, :]
-        table.loc[:, table.columns[0]] = table.columns[0]
-        table.columns = ['service', question, 'frequency']
-        table['percent'] = table['frequency']/np.float(table['frequency'].sum()) * 100
-        table['percent'] = table['percent'].round()
-        table_list.append(table)
-
-    long_table = pd.concat(table_list)
-    long_table.sort_values(by=['service', question])
-    long_table['service'] = long_table['service'].map(lambda x: x[3:])
+    if new_figure:
+        plt.tight_layout()
+
+def write_exploratory_pdf(file_path, tables, template, rows=6, columns=1, figsize=(8.27, 11.69)):
+    """Draws the exploratory plots of many questions into one multi-page pdf, with a grid of rows x columns
+    plots (titled with the question label) per page, instead of one figure per question.
+
+    tables is a dict or a list of (key, table) pairs like the output of gen_summary_tables: summary tables
+    keyed by question get a draw_basic_exp_plot, disaggregated tables keyed by (breakdown, question) get a
+    draw_disag_exp_plot. Only likert and binary questions of the template are plotted. The tables of a dict
+    are plotted in the question order of the template, each summary table followed by the disaggregated
+    tables of its question (as write_report orders them). Every page is written to the pdf and closed before
+    the next one is drawn. figsize is the page size in inches (A4)."""
+    from matplotlib.backends.backend_pdf import PdfPages
+
+    template = Template.compile(template)
+    if hasattr(tables, 'items'):
+        tables = [(key, tables[key]) for key in _report_order(tables.keys(), template)]
+    plots = []
+    skipped = []
+    for key, table in tables:
+        question = key[-1] if isinstance(key, tuple) else key
+        if question in template and template[question].question_type in ['likert', 'binary']:
+            plots.append((key, table, template[question].question_type == 'likert'))
+        else:
+            skipped.append(key)
+    if skipped:
+        print 'Only likert and binary questions are plotted, skipped:', skipped
+
+    use_style(style='white')
+    per_page = rows*columns
+    pdf = PdfPages(file_path)
+    try:
+        for start in range(0, len(plots), per_page):
+            fig, axes = plt.subplots(rows, columns, figsize=figsize, squeeze=False)
+            axes = axes.flatten()
+            for ax, (key, table, likert) in zip(axes, plots[start:start+per_page]):
+                if isinstance(key, tuple):
+                    draw_disag_exp_plot(table, likert, ax=ax)
+                else:
+                    draw_basic_exp_plot(table, likert, ax=ax)
+            for ax in axes[len(plots[start:start+per_page]):]:
+                ax.set_visible(False)
+            fig.tight_layout()
+            pdf.savefig(fig)
+            plt.close(fig)
+    finally:
+        pdf.close()
+
+def write_large_freq_table(data, column_list, name, top_k=None, writer=None):
+    """Combines data from several columns of open responses into one large frequency table. The table is
+    written to the sheet name of an open pd.ExcelWriter if one is given, and returned either way (e.g. to
+    pass it on to write_report)."""
+    frequency_table = count_open_responses(data, column_list, top_k)[['frequency']]
+    frequency_table.columns = ['value']
+    if writer is not None:
+        frequency_table.to_excel(writer, name, startrow=0)
+    return frequency_table
+
+def _report_question(key):
+    """The question of a report table key. Keys are question names or tuples ending in the question name
+    (as the disaggregated tables of gen_summary_tables are keyed)."""
+    question = key[-1] if isinstance(key, tuple) else key
+    if isinstance(question, basestring) and question.endswith('_quantiles'):
+        question = question[:-len('_quantiles')]
+    return question
+
+def _report_order(keys, template):
+    """Sorts report table keys in the question order of a Template (or None), keys of questions that are
+    not in the template come last. Keys of the same question are sorted among themselves."""
+    positions = {}
+    if template is not None:
+        positions = dict([(name, position) for position, name in enumerate(template.names)])
+    return sorted(keys, key=lambda key: (positions.get(_report_question(key), len(positions)), key))
+
+def _report_sheet_name(key, template, default_sheet):
+    """Finds the sheet of a report table: the question_section of its question in a Template (or None)."""
+    question = _report_question(key)
+    if template is None or question not in template or pd.isnull(template[question].section):
+        return default_sheet
+    sheet_name = str(template[question].section)
+    # Excel sheet names are at most 31 characters long and can't contain []:*?/\
+    return sheet_name.translate(None, '[]:*?/\\')[:31]
+
+def _excel_value(value):
+    """Turns a table cell into something xlsxwriter can write, missing values become blank cells"""
+    if isinstance(value, (tuple, list)):
+        return ' '.join([str(part) for part in value])
+    if pd.isnull(value):
+        return None
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (basestring, int, long, float, bool)):
+        return value
+    return str(value)
+
+def _table_rows(table):
+    """The header and data rows of a table, laid out as DataFrame.to_excel lays them out (index first)"""
+    index_names = [name if name is not None else '' for name in table.index.names]
+    yield index_names + [_excel_value(column) for column in table.columns]
+    for index, row in zip(table.index, table.values):
+        index = list(index) if isinstance(index, tuple) else [index]
+        yield [_excel_value(value) for value in index + list(row)]
+
+def write_report(file_path, tables, template=None, default_sheet='other', gap=2):
+    """Writes every table of a survey report to one Excel workbook with one sheet per question_section.
+
+    tables is a dict or a list of (key, table) pairs, e.g. the summary and disaggregated tables of
+    gen_summary_tables, or open response frequency tables. A value can also be a tuple of tables, such as
+    the (long_table, freq_table, per_table) that gen_multiple_choice_tables returns, keyed by question;
+    its tables are written one after the other. Keys are looked up in the template to find their section,
+    tables whose question is not in the template go to default_sheet. Tables are stacked down each sheet
+    with gap empty rows between them, in the order they are given, or for a dict in the question order of
+    the template (sorted by key without a template).
+
+    The workbook is written with xlsxwriter in constant memory mode: each sheet is written row by row in
+    one pass and flushed to disk before the next one is started."""
+    import xlsxwriter
+
+    if template is not None:
+        template = Template.compile(template)
+    if hasattr(tables, 'items'):
+        tables = [(key, tables[key]) for key in _report_order(tables.keys(), template)]
+    sheets = {}
+    sheet_order = []
+    for key, table in tables:
+        sheet_name = _report_sheet_name(key, template, default_sheet)
+        if sheet_name not in sheets:
+            sheets[sheet_name] = []
+            sheet_order.append(sheet_name)
+        if isinstance(table, (tuple, list)):
+            sheets[sheet_name].extend(table)
+        else:
+            sheets[sheet_name].append(table)
+
+    workbook = xlsxwriter.Workbook(file_path, {'constant_memory': True})
+    try:
+        for sheet_name in sheet_order:
+            worksheet = workbook.add_worksheet(sheet_name)
+            row_number = 0
+            for table in sheets[sheet_name]:
+                for row in _table_rows(table):
+                    worksheet.write_row(row_number, 0, row)
+                    row_number += 1
+                row_number += gap
+    finally:
+        workbook.close()
+
+def _multiple_choice_tables(selected, services, question, codes, categories):
+    """Builds the multiple choice tables from a rows x options boolean matrix of selected options and the
+    integer coded responses to the question (see _response_codes). All option x response counts come from
+    one matrix product of the selected options with the one-hot coded responses."""
+    valid = codes >= 0
+    one_hot = np.zeros((valid.sum(), len(categories)))
+    one_hot[np.arange(len(one_hot)), codes[valid]] = 1
+    counts = np.dot(np.asarray(selected)[valid].T.astype(float), one_hot).astype(int)
+
+    option_index, response_index = np.nonzero(counts)
+    frequency = counts[option_index, response_index]
+    percent = frequency/counts.sum(axis=1)[option_index].astype(float) * 100
+    long_table = pd.DataFrame({'service': np.asarray(services, dtype=object)[option_index],
+                               question: categories[response_index],
+                               'frequency': frequency, 'percent': percent.round()},
+                              columns=['service', question, 'frequency', 'percent'])
 
     freq_table = long_table.pivot(index='service', columns=question, values='frequency')
     freq_table = freq_table.fillna(0)
@@ -363,10 +986,37 @@ def gen_multiple_choice_tables(option_list, question):
     per_table = per_table.fillna(0)
     return long_table, freq_table, per_table
 
-def draw_np_plot(data, question):
+def _service_name(option):
+    """The service an option stands for in the multiple choice tables: the option name without its
+    three character prefix (e.g. 'food' for 'Sa_food')"""
+    return option[3:]
+
+def gen_multiple_choice_tables(data, option_list, question):
+    """This is a function that generates frequency and output tables for multiple choice questions.
+    It takes three inputs: the data, a list of column names for the various options (one True/False
+    column per option), and the column name of the question the tables should be generated for.
+    Returns a long table of frequencies and percentages (of the respondents who selected the option) per
+    option and response, and the same frequencies and percentages pivoted to options x responses."""
+    selected = data[option_list].values == True
+    codes, categories = _response_codes(data[question])
+    services = [_service_name(option) for option in option_list]
+    return _multiple_choice_tables(selected, services, question, codes, categories)
+
+def gen_multiple_choice_tables_from_column(data, column, question, options):
+    """Same tables as gen_multiple_choice_tables for a multiple choice question stored as one comma
+    separated column (see data_cleaning.parse_multiple_choice) rather than one column per option.
+    options are the column's response options, as a list or a template cell. Services are named as in
+    gen_multiple_choice_tables."""
+    options = parse_response_options(options)
+    selected = unpack_multiple_choice(parse_multiple_choice(data[column], options), len(options))
+    codes, categories = _response_codes(data[question])
+    services = [_service_name(option) for option in options]
+    return _multiple_choice_tables(selected, services, question, codes, categories)
+
+def draw_np_plot(data, question, export_profile=DEFAULT_EXPORT_PROFILE):
     '''Draw plots for net promoter distributions, adhearing to the
     Keystone standard.'''
-    sns.set(style='white')
+    use_style(style='white')
 
     # generating table
     table = pd.DataFrame(data[question].value_counts(sort=False, normalize=True))
@@ -402,13 +1052,12 @@ def draw_np_plot(data, question):
 
     # saving the figure
     question_name = ('_').join(question.split('. '))
-    plt.savefig('../../output/'+question_name+'.pdf', dpi=600, transparent=True)
-    plt.savefig('../../output/'+question_name+'.jpg', dpi=600, transparent=True)
+    export_figure(fig, '../../output/'+question_name, ('pdf', 'jpg'), export_profile)
     plt.close()
 
 def draw_exp_np_plot(data, question):
     '''A version of the netpromoter plot for exploratory pdfs.'''
-    sns.set(style='white')
+    use_style(style='white')
 
     # generating table
     table = pd.DataFrame(data[question].value_counts(sort=False, normalize=True))
@@ -443,63 +1092,57 @@ def draw_exp_np_plot(data, question):
     fig.subplots_adjust(top = 0.99, bottom = 0.01, right = 0.99, left = 0.01,
             hspace = 0, wspace = 0)
 
-def calculate_fp_se(data= data, questions = [], N= int):
+def calculate_fp_se(data, questions, N):
     '''Function to calculate standard errors for finite populations. Should be used instead
     instead of normal standard errors when the sample covers more than 15% of the intended
-    target population'''
+    target population. Each question uses its own number of responses as n.'''
     std = data.loc[:, questions].std()
-    n = np.float(data.loc[:, questions[0]].count())
+    n = data.loc[:, questions].count().astype(float)
     se = std/np.sqrt(n)
     fp_se = se*np.sqrt(((N-n)/(N-1.0)))
     fp_se = fp_se.round(2)
     return fp_se
 
-def draw_basic_poster_plot(table, likert=True):
+def calculate_stratified_fp_se(data, questions, breakdown, population_sizes, decimals=2):
+    '''Calculates finite population standard errors for every question in every stratum (e.g. camp) of
+    a breakdown at once. population_sizes maps each value of the breakdown to the size of its population.
+    Counts, means and standard deviations come from one groupby. Returns a tidy table with one row per
+    stratum and question, with the columns breakdown, question, N, count, mean, std, se and fp_se.
+    Strata without a population size get a missing fp_se.'''
+    stats = data.groupby(breakdown)[questions].agg(['count', 'mean', 'std'])
+    stats = stats.stack(level=0)
+    stats.index.names = [breakdown, 'question']
+    stats = stats.reset_index()
+
+    stats['N'] = stats[breakdown].map(population_sizes)
+    missing = sorted(stats.loc[stats['N'].isnull(), breakdown].unique())
+    if missing:
+        print 'No population size for:', missing
+    n = stats['count'].astype(float)
+    stats['se'] = stats['std']/np.sqrt(n)
+    stats['fp_se'] = stats['se']*np.sqrt((stats['N']-n)/(stats['N']-1.0))
+    stats = stats[[breakdown, 'question', 'N', 'count', 'mean', 'std', 'se', 'fp_se']]
+    stats[['mean', 'std', 'se', 'fp_se']] = stats[['mean', 'std', 'se', 'fp_se']].round(decimals)
+    return stats
+
+def draw_basic_poster_plot(table, likert=True, export_profile=DEFAULT_EXPORT_PROFILE):
     """Generates and saves standard GT bar plots from summary tables of likert questions and binary questions."""
-    sns.set(style='white')
-    table2 = table.set_index(table.columns[0])
-    table2 = table2.transpose()
-    table2.loc['', :] = np.zeros(len(table2.columns))
-
-    if likert == True:
-        likert_dict ={1: "#f19891", 2: "#f8cac3", 3:"#e9ecf0", 4:"#b2cfb3", 5:"#4aa168", 6:"#c9d5dd", 7:'#9bb2bf'}
-        likert_keys = [np.int(label.split('_')[0]) for label in table2.columns]
-        likert_colours = sns.color_palette([likert_dict[x] for x in likert_keys])
-        colours = likert_colours
-    else:
-        binary_dict = {1: "#f19891", 2: "#4aa168", 3: "#c9d5dd", 4: '#9bb2bf'}
-        binay_keys = [np.int(label.split('_')[0]) for label in table2.columns]
-        binary_colours = sns.color_palette([binary_dict[x] for x in binary_keys])
-        colours = binary_colours
+    use_style(style='white')
+    table2 = _summary_plot_table(table)
+    colours = response_palette(table2.columns, likert)
 
-    fig, ax = plt.subplots(figsize=(mm2inch(220), mm2inch(23.5)))
-    table2.loc[('', 'percent'), :].plot(kind='barh', stacked=True, color=colours, legend=False, width=0.6,
-                                              ax=ax)
-    sns.despine(top=True, right=True, left=True, bottom=True)
-    ax.set(xlim=(0, table2.loc['percent', :].sum()), ylim=(0.7, 1.3), yticklabels=(), xticklabels=[])
-
-    #create the white spaces between the squares
-    rects = ax.patches
-    [rect.set(edgecolor='white', linewidth=1) for rect in rects]
-
-    # Adding the percentage labels
-    for p in ax.patches:
-        if p.get_width() > 0:
-            ax.annotate("{0:.0f}".format(p.get_width()),
-                    (p.get_x() + p.get_width()/2, p.get_y()), xytext=(0, 23), textcoords='offset points',
-                    weight='bold', size=30, ha='center')
+    fig, ax, labels = _draw_summary_bars(table2, colours, (mm2inch(220), mm2inch(23.5)), 1, 23, 30)
     question_name = table2.columns.name
     fig.subplots_adjust(top = 0.99, bottom = 0.01, right = 1, left = 0,
             hspace = 0, wspace = 0)
-    plt.savefig('../../output/'+question_name+'.pdf', dpi=600, transparent=True)
-    plt.savefig('../../output/'+question_name+'.jpg', dpi=600, transparent=True)
+    export_figure(fig, '../../output/'+question_name, ('pdf', 'jpg'), export_profile)
     plt.close()
 
-def draw_mean_breakdown_plot(data, breakdown, variable, filename=None):
+def draw_mean_breakdown_plot(data, breakdown, variable, filename=None, export_profile=DEFAULT_EXPORT_PROFILE):
     """Plots means as a pointplot a function of a breakdown variable"""
     if filename==None:
         filename=variable.split('_')[0]
-    sns.set(style='whitegrid', font_scale=1.5)
+    use_style(style='whitegrid', font_scale=1.5)
     fig, ax = plt.subplots(figsize=(7.5, 3))
     sns.pointplot(x=breakdown, y=variable, data=data,
                   join=False, scale=1.2, errwidth=8, color='#65889d')
@@ -509,18 +1152,10 @@ def draw_mean_breakdown_plot(data, breakdown, variable, filename=None):
     plt.hlines(mean_data_full[variable].mean(), -1, 3, lw=3, linestyles='dashed',
               zorder=1)
 
-    plt.savefig('../../output/' + filename + '.pdf', dpi=600, transparent=True)
-    plt.savefig('../../output/' + filename + '.png', dpi=600, transparent=True)
-
-def draw_np_hist_plot(data=data,
-            question='',
-            filename='temp'):
-    sns.set(style='white', font_scale=0.8)
-    """ Draws a histogram of response distributions for 11-point likert
-    scale questions, with colours signaling the contribution of various
-    response categories to the net promoter score. Useful as a visual
-    explanation of how the raw scores relate to the NPS scores"""
+    export_figure(fig, '../../output/' + filename, ('pdf', 'png'), export_profile)
 
+def _np_frequencies(data, question):
+    """Response frequencies of an 11-point question, with a 0 for every score nobody gave"""
     data = data.loc[data[question].notnull(), question]
 
     # Now let's make a frequency table to plot
@@ -528,9 +1163,18 @@ def draw_np_hist_plot(data=data,
     for number in np.arange(0, 11):
         if number not in frequencies.index:
             frequencies.set_value(number, 0)
-    frequencies = frequencies.sort_index()
-    max_freq = frequencies.max()
-
+    return frequencies.sort_index()
+
+def _update_np_labels(bars, labels):
+    """Puts the frequency of every bar above it, the labels of empty bars are hidden"""
+    for bar, label in zip(bars, labels):
+        height = bar.get_height()
+        label.set_text(int(height))
+        label.set_position((bar.get_x() + bar.get_width()/2, height))
+        label.set_visible(height != 0)
+
+def _draw_np_hist(frequencies):
+    """Draws the NP histogram of a frequency table, returns the figure, axes and bar labels"""
     fig, ax = plt.subplots(figsize=(mm2inch(85.55), mm2inch(45)))
     plt.bar(frequencies.index, frequencies.values, width=1)
     sns.despine(left=True)
@@ -546,18 +1190,108 @@ def draw_np_hist_plot(data=data,
     ax.tick_params(direction='out', pad=2)
     [label.set_weight('bold') for label in ax.xaxis.get_ticklabels()]
 
-
-
-    for rect in ax.patches:
-        height = rect.get_height()
-        if height != 0:
-            ax.text(rect.get_x() + rect.get_width()/2, height, int(height),
-                    ha='center', va='bottom', size=8, color='#666666')
+    labels = [ax.text(0, 0, '', ha='center', va='bottom', size=8, color='#666666') for rect in ax.patches]
+    _update_np_labels(ax.patches, labels)
 
     fig.subplots_adjust(top = 0.86, bottom = 0.08, right = 0.99, left = 0.01,
                 hspace = 0, wspace = 0)
+    return fig, ax, labels
+
+def draw_np_hist_plot(data,
+            question='',
+            filename='temp',
+            export_profile=DEFAULT_EXPORT_PROFILE):
+    use_style(style='white', font_scale=0.8)
+    """ Draws a histogram of response distributions for 11-point likert
+    scale questions, with colours signaling the contribution of various
+    response categories to the net promoter score. Useful as a visual
+    explanation of how the raw scores relate to the NPS scores"""
+
+    frequencies = _np_frequencies(data, question)
+    fig, ax, labels = _draw_np_hist(frequencies)
 
     savepath='../../output/' + filename
 
-    plt.savefig(savepath+'.png', dpi=600, transparent=True)
-    plt.savefig(savepath+'.pdf', dpi=600, transparent=True)
+    export_figure(fig, savepath, ('png', 'pdf'), export_profile)
+
+class FigurePool(object):
+    """Batch plotting mode that reuses figures instead of creating and closing one for every question.
+
+    The pool keeps one figure per layout: basic and poster summary plots per number of responses,
+    disaggregated plots per figure height and number of groups and responses, and NP histograms. The
+    first plot of a layout is drawn as the module's draw functions draw it, later plots of that layout
+    move, resize and recolour the bars and update the labels of that figure in place and save it again,
+    giving the same files as the draw functions. Call close() when the batch is done."""
+
+    def __init__(self):
+        self.figures = {}
+
+    def draw_basic_plot(self, table, likert=True, folder_path='../../output/', export_profile=DEFAULT_EXPORT_PROFILE):
+        """Same plot as draw_basic_plot"""
+        use_style(style='white')
+        table2 = _summary_plot_table(table)
+        colours = response_palette(table2.columns, likert)
+        key = ('basic', len(table2.columns))
+        if key in self.figures:
+            fig, ax, labels = self.figures[key]
+            _update_summary_bars(ax, labels, table2, colours)
+        else:
+            fig, ax, labels = _draw_summary_bars(table2, colours, (7.5, 1), 3, 29, 15)
+            fig.subplots_adjust(top = 0.99, bottom = 0.01, right = 0.99, left = 0.01,
+                    hspace = 0, wspace = 0)
+            self.figures[key] = (fig, ax, labels)
+        export_figure(fig, folder_path+table2.columns.name, ('pdf', 'jpg'), export_profile)
+
+    def draw_basic_poster_plot(self, table, likert=True, export_profile=DEFAULT_EXPORT_PROFILE):
+        """Same plot as draw_basic_poster_plot"""
+        use_style(style='white')
+        table2 = _summary_plot_table(table)
+        colours = response_palette(table2.columns, likert)
+        key = ('poster', len(table2.columns))
+        if key in self.figures:
+            fig, ax, labels = self.figures[key]
+            _update_summary_bars(ax, labels, table2, colours)
+        else:
+            fig, ax, labels = _draw_summary_bars(table2, colours, (mm2inch(220), mm2inch(23.5)), 1, 23, 30)
+            fig.subplots_adjust(top = 0.99, bottom = 0.01, right = 1, left = 0,
+                    hspace = 0, wspace = 0)
+            self.figures[key] = (fig, ax, labels)
+        export_figure(fig, '../../output/'+table2.columns.name, ('pdf', 'jpg'), export_profile)
+
+    def draw_disag_plot(self, table, likert=True, reindex_order=np.nan, folder_path='../../output/',
+                        export_profile=DEFAULT_EXPORT_PROFILE):
+        """Same plot as draw_disag_plot"""
+        use_style(style='white')
+        fig_height = len(table.loc[:, table.columns[0]].unique())
+        table2 = _disag_plot_table(table, reindex_order)
+        colours = response_palette(table2.columns, likert)
+        key = ('disag', fig_height) + table2.shape
+        if key in self.figures:
+            fig, ax, labels = self.figures[key]
+            _update_stacked_bars(ax.patches, table2.fillna(0).values, colours)
+            _update_bar_labels(ax.patches, labels)
+        else:
+            fig, ax, labels = _draw_disag_bars(table2, colours, fig_height)
+            self.figures[key] = (fig, ax, labels)
+        export_figure(fig, _disag_plot_path(table2, folder_path), ('pdf', 'jpg'), export_profile)
+
+    def draw_np_hist_plot(self, data, question='', filename='temp', export_profile=DEFAULT_EXPORT_PROFILE):
+        """Same plot as draw_np_hist_plot"""
+        use_style(style='white', font_scale=0.8)
+        frequencies = _np_frequencies(data, question)
+        key = ('np_hist', tuple(frequencies.index))
+        if key in self.figures:
+            fig, ax, labels = self.figures[key]
+            for bar, height in zip(ax.patches, frequencies.values):
+                bar.set_height(height)
+            _update_np_labels(ax.patches, labels)
+        else:
+            fig, ax, labels = _draw_np_hist(frequencies)
+            self.figures[key] = (fig, ax, labels)
+        export_figure(fig, '../../output/' + filename, ('png', 'pdf'), export_profile)
+
+    def close(self):
+        """Closes all figures of the pool"""
+        for fig, ax, labels in self.figures.values():
+            plt.close(fig)
+        self.figures = {}